@@ -4,14 +4,13 @@ from flask_login import LoginManager, current_user
 from flask_cors import CORS
 
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy.pool import NullPool
 
 from functools import wraps
 from typing import Any, Callable, Literal
-from io import BytesIO
 
-import requests
+import datetime
 import hashids
 import logging
 import os
@@ -65,21 +64,58 @@ hid = hashids.Hashids(min_length = 8, salt = os.environ.get("HASHID_SALT", os.en
 
 os.makedirs(app.instance_path, exist_ok=True)
 
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///db.sqlite")
+
+def engine_options(url: str) -> dict[str, Any]:
+    """ Pooled engine settings; SQLite connections are shared across threads, other databases get liveness checks """
+    options: dict[str, Any] = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+    }
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"timeout": 30, "check_same_thread": False}
+    else:
+        options["pool_pre_ping"] = True
+        options["pool_recycle"] = 3600
+    return options
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """ Run on every new SQLite connection; WAL lets readers proceed while one writer commits """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
+        cursor.execute("PRAGMA synchronous = NORMAL")  # Durable across app crashes in WAL mode, fsyncs only at checkpoints
+        cursor.execute("PRAGMA busy_timeout = 30000")
+        cursor.execute(f"PRAGMA cache_size = -{app.config['SQLITE_CACHE_KB']}")
+        cursor.execute(f"PRAGMA mmap_size = {app.config['SQLITE_MMAP_BYTES']}")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+    finally:
+        cursor.close()
+
 app.config.from_mapping(
     SECRET_KEY = os.environ.get("SECRET_KEY", "dev"),
     DATABASE = os.path.join(app.instance_path, "db.sqlite"),
-    SQLALCHEMY_DATABASE_URI = f"sqlite:///db.sqlite?timeout=30&check_same_thread=False",
+    SQLALCHEMY_DATABASE_URI = DATABASE_URL,
+    SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),  # WAL needs a local filesystem, use DELETE on network shares
+    SQLITE_CACHE_KB = int(os.environ.get("SQLITE_CACHE_KB", 64 * 1024)),
+    SQLITE_MMAP_BYTES = int(os.environ.get("SQLITE_MMAP_BYTES", 256 * 1024 * 1024)),
+    QUERY_COUNT_HEADER = os.environ.get("QUERY_COUNT_HEADER", "0") == "1",
+    USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 60)),
+    ACCESS_CACHE_TTL = float(os.environ.get("ACCESS_CACHE_TTL", 30)),
+    SETS_PER_PAGE = int(os.environ.get("SETS_PER_PAGE", 24)),
+    JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2)),
+    JOB_STALE_AFTER = int(os.environ.get("JOB_STALE_AFTER", 3600)),     # Seconds without an update before a running job counts as abandoned
+    JOB_RETENTION = int(os.environ.get("JOB_RETENTION", 24 * 3600)),    # Seconds finished jobs and export files are kept
+    INAT_ENGINE = os.environ.get("INAT_ENGINE", "async"),  # "async" or "threads"
+    INAT_TIMEOUT = float(os.environ.get("INAT_TIMEOUT", 120)),
+    IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", 25 * 1024 * 1024)),
+    IMAGE_FETCH_WORKERS = int(os.environ.get("IMAGE_FETCH_WORKERS", 8)),
+    IMAGE_BATCH_MAX = int(os.environ.get("IMAGE_BATCH_MAX", 500)),
+    IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+    IMAGE_CACHE_TTL = int(os.environ.get("IMAGE_CACHE_TTL", 7 * 24 * 3600)),
     SQLALCHEMY_TRACK_MODIFICATIONS = False,
     TEMPLATES_AUTO_RELOAD = True,
-    SQLALCHEMY_ENGINE_OPTIONS = {
-        "connect_args": {
-            "timeout": 30,
-            "check_same_thread": False,
-        },
-        "pool_pre_ping": True,
-        "pool_recycle": 3600,
-        "poolclass": NullPool,
-    },
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(DATABASE_URL),
 )
 
 # Helper function to log with immediate flush
@@ -93,7 +129,12 @@ ROOT_PATH = os.path.split(app.root_path)[0]
 UPLOAD_PATH = os.path.join(ROOT_PATH, "static", "uploads")
 VALID_IMG_EXTENSIONS = ["png", "jpg", "jpeg"]
 EXPORT_PATH = os.path.join(UPLOAD_PATH, "exports")
+IMAGE_CACHE_PATH = os.path.join(app.instance_path, "image_cache")
+INAT_CACHE_DB = os.environ.get("INAT_CACHE_DB", os.path.join(app.instance_path, "inaturalist_cache.sqlite"))
 DEFAULT_THUMBNAIL_URL = 'img/default_thumbnail.png'
+MIGRATIONS_PATH = os.path.join(ROOT_PATH, "migrations")
+
+migrate = Migrate(directory = MIGRATIONS_PATH, render_as_batch = True)  # SQLite needs batch mode to alter tables
 
 def decode(hashid: str) -> int | Literal[False]:
     decoded = hid.decode(hashid)
@@ -117,6 +158,20 @@ def encode_image(set_id: int, image_id: int) -> str:
 def encode(number: int) -> str:
     return hid.encode(number)
 
+CURSOR_EPOCH = datetime.datetime(1970, 1, 1)
+
+def encode_cursor(created_at: datetime.datetime, row_id: int) -> str:
+    """ Opaque keyset cursor for a (created_at, id) position """
+    return hid.encode((created_at - CURSOR_EPOCH) // datetime.timedelta(microseconds = 1), row_id)
+
+def decode_cursor(cursor: str | None) -> tuple[datetime.datetime, int] | None | Literal[False]:
+    """ Position encoded by `encode_cursor`, None for the first page, False if the cursor is invalid """
+    if not cursor: return None
+    decoded = hid.decode(cursor)
+    if len(decoded) != 2: return False
+    micros, row_id = decoded
+    return CURSOR_EPOCH + datetime.timedelta(microseconds = micros), row_id
+
 def get_data(objects: list[Any]) -> list[dict[str, int | str | None]]:
     results: list[dict[str, int | str | None]] = []
     
@@ -150,13 +205,17 @@ def draft_access_required(func: Callable) -> Callable:
     @wraps(func)
     def wrapper(draft_hash: str, *args, **kwargs):
         from app.models import Draft
+        from app.lib.access import can_access_draft
 
         draft_id = decode(draft_hash)
         if draft_id is False: return "Draft not found", 404
 
-        draft = Draft.query.get(draft_id)
+        # Decide before loading the row; a denied id is only looked up to tell 403 from 404
+        if not current_user.is_authenticated or not can_access_draft(current_user, draft_id):
+            return ("Access denied", 403) if db.session.get(Draft, draft_id) is not None else ("Draft not found", 404)
+
+        draft = db.session.get(Draft, draft_id)
         if not isinstance(draft, Draft): return "Draft not found", 404
-        if not current_user.is_authenticated or not current_user.has_access_to(draft): return "Access denied", 403
 
         return func(draft, *args, **kwargs)
     return wrapper
@@ -165,14 +224,16 @@ def set_access_required(func: Callable) -> Callable:
     @wraps(func)
     def wrapper(set_hash: str, *args, **kwargs):
         from app.models import Set
+        from app.lib.access import can_access_set
 
         set_id = decode(set_hash)
         if set_id is False: return "Set not found", 404
 
-        set_ = Set.query.get(set_id)
+        if not can_access_set(current_user, set_id):
+            return ("Access denied", 403) if db.session.get(Set, set_id) is not None else ("Set not found", 404)
+
+        set_ = db.session.get(Set, set_id)
         if not isinstance(set_, Set): return "Set not found", 404
-        if set_.is_public: return func(set_, *args, **kwargs)
-        if not current_user.is_authenticated or not current_user.has_access_to(set_): return "Access denied", 403
 
         return func(set_, *args, **kwargs)
     return wrapper
@@ -195,20 +256,21 @@ def format_number(value: int | float) -> str:
 
 @app.route('/proxy-image')
 def proxy_image():
+    from app.lib.image_cache import image_cache
+    from app.lib.image_download import ImageFetchError
+
     url = request.args.get('url')
     if not url: return "URL parameter is required", 400
-    
+
     try:
-        # Bypass proxy to avoid connection issues
-        proxies = {}
-        headers = {'User-Agent': 'Recognify'}
-        response = requests.get(url, timeout=10, proxies=proxies, headers=headers)
-        response.raise_for_status()
-        
-        return send_file(
-            BytesIO(response.content),
-            mimetype=response.headers.get('Content-Type', 'image/jpeg'),
-            as_attachment=False
-        )
-    except requests.RequestException as e:
+        file, entry = image_cache.open(url)
+    except ImageFetchError as e:
         return f"Error fetching image: {str(e)}", 500
+
+    return send_file(
+        file,
+        mimetype = entry["mimetype"],
+        as_attachment = False,
+        etag = entry["key"],
+        max_age = 86400,  # Cache for 24 hours
+    )
@@ -0,0 +1,132 @@
+import time
+import threading
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event, exists, inspect, select
+
+from app.app import db
+from app.models import Draft, DraftAccess, Set
+
+DRAFT = "draft"
+SET   = "set"
+
+
+class AccessCache:
+    """
+    Access decisions shared across requests, keyed by target and user.
+    Writes in this process invalidate their targets when flushed and again when committed; other processes
+    only see a change once their entry expires, so `ttl` bounds how long a revoked grant can survive there.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[tuple[str, int], dict[int | None, tuple[bool, float]]] = {}
+
+    def get(self, target: tuple[str, int], user_id: int | None) -> bool | None:
+        with self._lock:
+            entry = self._entries.get(target, {}).get(user_id)
+        if entry is None or entry[1] < time.monotonic(): return None
+        return entry[0]
+
+    def put(self, target: tuple[str, int], user_id: int | None, allowed: bool, ttl: float) -> None:
+        with self._lock:
+            self._entries.setdefault(target, {})[user_id] = (allowed, time.monotonic() + ttl)
+
+    def invalidate(self, targets: set[tuple[str, int]]) -> None:
+        with self._lock:
+            for target in targets: self._entries.pop(target, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+cache = AccessCache()
+
+
+def draft_query(user_id: int, draft_id: int):
+    shared = exists().where(DraftAccess.draft_id == draft_id, DraftAccess.user_id == user_id)
+    return select(exists().where(Draft.id == draft_id, (Draft.owner_id == user_id) | shared))
+
+def set_query(user_id: int | None, set_id: int):
+    """ Same rule as `Set.visible_to`: public, owned, or the user owns or shares the set's draft """
+    if user_id is None: return select(exists().where(Set.id == set_id, Set.is_public == True))
+
+    shared = select(Draft.id).outerjoin(DraftAccess, Draft.id == DraftAccess.draft_id)\
+        .where(Draft.set_id == set_id, (Draft.owner_id == user_id) | (DraftAccess.user_id == user_id)).exists()
+    return select(exists().where(Set.id == set_id, (Set.is_public == True) | (Set.owner_id == user_id) | shared))
+
+
+def resolve(kind: str, target_id: int, user_id: int | None) -> bool:
+    """ Memoized per request in `g`, then in the shared cache, then one EXISTS query """
+    target = (kind, target_id)
+    memo: dict = g.setdefault("access", {}) if has_app_context() else {}
+    if (target, user_id) in memo: return memo[(target, user_id)]
+
+    allowed = cache.get(target, user_id)
+    if allowed is None:
+        if kind == DRAFT: allowed = user_id is not None and bool(db.session.execute(draft_query(user_id, target_id)).scalar())
+        else: allowed = bool(db.session.execute(set_query(user_id, target_id)).scalar())
+        cache.put(target, user_id, allowed, current_app.config["ACCESS_CACHE_TTL"])
+
+    memo[(target, user_id)] = allowed
+    return allowed
+
+def user_id_of(user) -> int | None:
+    if user is None or not getattr(user, "is_authenticated", False): return None
+    return user.id
+
+def can_access_draft(user, draft_id: int) -> bool:
+    return resolve(DRAFT, draft_id, user_id_of(user))
+
+def can_access_set(user, set_id: int) -> bool:
+    return resolve(SET, set_id, user_id_of(user))
+
+def can_access(user, to: "Draft | Set | None") -> bool:
+    if isinstance(to, Draft): return can_access_draft(user, to.id)
+    if isinstance(to, Set): return can_access_set(user, to.id)
+    return False
+
+
+# Columns each decision depends on; a flush touching them drops the affected decisions
+WATCHED = {DraftAccess: ("draft_id", "user_id"), Draft: ("owner_id", "set_id"), Set: ("is_public", "owner_id")}
+
+
+def changed_targets(session) -> set[tuple[str, int]]:
+    targets: set[tuple[str, int]] = set()
+
+    for obj in session.new | session.dirty | session.deleted:
+        keys = WATCHED.get(type(obj))
+        if keys is None: continue
+        state = inspect(obj)
+        if obj in session.dirty and not any(state.attrs[key].history.has_changes() for key in keys): continue
+
+        if isinstance(obj, DraftAccess):
+            for draft_id in state.attrs.draft_id.history.sum():
+                if not draft_id: continue
+                targets.add((DRAFT, draft_id))
+                draft = session.get(Draft, draft_id)
+                if draft is not None and draft.set_id: targets.add((SET, draft.set_id))
+        elif isinstance(obj, Draft):
+            targets.add((DRAFT, obj.id))
+            targets.update((SET, set_id) for set_id in state.attrs.set_id.history.sum() if set_id)
+        else:
+            targets.add((SET, obj.id))
+    return targets
+
+
+@event.listens_for(db.session, "after_flush")
+def invalidate_flushed(session, flush_context) -> None:
+    targets = changed_targets(session)
+    if not targets: return
+    cache.invalidate(targets)
+    session.info.setdefault("access_targets", set()).update(targets)
+    if has_app_context(): g.pop("access", None)
+
+@event.listens_for(db.session, "after_commit")
+def invalidate_committed(session) -> None:
+    # Another request may have cached the old decision between the flush and the commit
+    cache.invalidate(session.info.pop("access_targets", set()))
+
+
+__all__ = ["AccessCache", "cache", "can_access", "can_access_draft", "can_access_set"]
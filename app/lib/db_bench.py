@@ -0,0 +1,102 @@
+import os
+import time
+import random
+import tempfile
+import threading
+import click
+
+from sqlalchemy import create_engine, delete, event, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+
+from app.app import app, apply_sqlite_pragmas, db, engine_options
+from app.models import Image, Set, SkipImage, User
+
+USERS  = 50
+IMAGES = 200
+
+
+def baseline_engine(path: str) -> Engine:
+    """ The previous setup: a fresh connection per checkout, rollback journal, full fsync """
+    engine = create_engine(f"sqlite:///{path}", poolclass = NullPool, connect_args = {"timeout": 30, "check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def rollback_journal(dbapi_connection, connection_record) -> None:
+        dbapi_connection.execute("PRAGMA journal_mode = DELETE")
+        dbapi_connection.execute("PRAGMA synchronous = FULL")
+    return engine
+
+def tuned_engine(path: str) -> Engine:
+    """ The configured setup, as `SQLALCHEMY_ENGINE_OPTIONS` and the connect pragmas build it """
+    url = f"sqlite:///{path}"
+    engine = create_engine(url, **engine_options(url))
+    event.listen(engine, "connect", apply_sqlite_pragmas)
+    return engine
+
+
+def seed(engine: Engine) -> int:
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"username": f"bench{i}", "password": ""} for i in range(USERS)])
+        set_id = conn.execute(insert(Set).values(name = "Bench", description = "", owner_id = 1, is_public = True)).inserted_primary_key[0]
+        conn.execute(insert(Image), [{"set_id": set_id, "filename": f"img_{i}.png", "label": f"Label {i}", "notes": ""} for i in range(IMAGES)])
+    return set_id
+
+def play_images(conn, set_id: int, user_id: int) -> list:
+    skipped = select(SkipImage.id).where(SkipImage.image_id == Image.id, SkipImage.user_id == user_id).exists()
+    return conn.execute(select(Image.id, Image.label, Image.notes).where(Image.set_id == set_id, ~skipped)).all()
+
+def toggle_skip(conn, image_id: int, user_id: int) -> None:
+    removed = conn.execute(delete(SkipImage).where(SkipImage.user_id == user_id, SkipImage.image_id == image_id)).rowcount
+    if not removed:
+        conn.execute(sqlite_insert(SkipImage).values(user_id = user_id, image_id = image_id).on_conflict_do_nothing(index_elements = ["user_id", "image_id"]))
+
+
+def run(engine: Engine, set_id: int, threads: int, seconds: float, write_ratio: float) -> tuple[int, int]:
+    """ Operations completed and failed by `threads` workers in `seconds` """
+    done = [0] * threads
+    failed = [0] * threads
+    deadline = time.monotonic() + seconds
+
+    def worker(index: int) -> None:
+        rng = random.Random(index)
+        while time.monotonic() < deadline:
+            user_id = rng.randint(1, USERS)
+            try:
+                if rng.random() < write_ratio:
+                    with engine.begin() as conn: toggle_skip(conn, rng.randint(1, IMAGES), user_id)
+                else:
+                    with engine.connect() as conn: play_images(conn, set_id, user_id)
+                done[index] += 1
+            except Exception:
+                failed[index] += 1
+
+    workers = [threading.Thread(target = worker, args = (i,)) for i in range(threads)]
+    for thread in workers: thread.start()
+    for thread in workers: thread.join()
+    return sum(done), sum(failed)
+
+
+@app.cli.command("bench-db")
+@click.option("--threads", default = 8, show_default = True)
+@click.option("--seconds", default = 5.0, show_default = True)
+@click.option("--write-ratio", default = 0.2, show_default = True, help = "Share of operations that toggle a skip")
+def bench_db(threads: int, seconds: float, write_ratio: float) -> None:
+    """ Compare the old and the tuned SQLite engine on play-page reads mixed with skip clicks """
+    results: dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, build in (("baseline", baseline_engine), ("tuned", tuned_engine)):
+            engine = build(os.path.join(directory, f"{name}.sqlite"))
+            try:
+                set_id = seed(engine)
+                done, failed = run(engine, set_id, threads, seconds, write_ratio)
+            finally:
+                engine.dispose()
+            results[name] = done / seconds
+            click.echo(f"{name:>8}: {results[name]:9.1f} ops/s ({done} ok, {failed} failed)")
+
+    if results["baseline"]: click.echo(f"{results['tuned'] / results['baseline']:.2f}x")
+
+
+__all__ = ["baseline_engine", "tuned_engine", "run"]
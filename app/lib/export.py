@@ -32,12 +32,18 @@ def export_draft(draft: Draft) -> str | Literal[False]:
 
 def import_draft(file: FileStorage) -> int | Literal[False]:
     if not current_user.is_authenticated: return False
+    return import_draft_from_path(save_import(file), current_user.id)
 
+def save_import(file: FileStorage) -> str:
+    """ Save an uploaded export archive and return its path. """
     os.makedirs(EXPORT_PATH, exist_ok=True)
     filename = get_free_filename(EXPORT_PATH, "zip", "import")
-    file.save(os.path.join(EXPORT_PATH, filename))
+    path = os.path.join(EXPORT_PATH, filename)
+    file.save(path)
+    return path
 
-    with zipfile.ZipFile(os.path.join(EXPORT_PATH, filename), 'r') as zip:
+def import_draft_from_path(path: str, owner_id: int) -> int | Literal[False]:
+    with zipfile.ZipFile(path, 'r') as zip:
         if 'export.json' not in zip.namelist():
             return False
         
@@ -47,7 +53,7 @@ def import_draft(file: FileStorage) -> int | Literal[False]:
         # Create a new draft
         draft = Draft()
         draft.name = data.get("name", "Imported Draft")
-        draft.owner_id = current_user.id
+        draft.owner_id = owner_id
         db.session.add(draft)
         db.session.commit()
 
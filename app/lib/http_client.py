@@ -0,0 +1,74 @@
+
+import os
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+from urllib3.util.retry import Retry
+
+HEADERS = {'User-Agent': 'Recognify'}
+
+# Number of hosts to keep connection pools for, and connections kept alive per host.
+# Pools block when full, so HOST_CONCURRENCY also caps concurrent requests to a single host.
+POOL_HOSTS       = int(os.environ.get("HTTP_POOL_HOSTS", 16))
+HOST_CONCURRENCY = int(os.environ.get("HTTP_HOST_CONCURRENCY", 8))
+RETRIES          = int(os.environ.get("HTTP_RETRIES", 3))
+BACKOFF_FACTOR   = float(os.environ.get("HTTP_BACKOFF_FACTOR", 0.5))
+POOL_TIMEOUT     = float(os.environ.get("HTTP_POOL_TIMEOUT", 30))  # Seconds to wait for a free connection to a busy host
+
+
+class PoolTimeout:
+    """ Mixin for connection pools: wait at most `pool_timeout` seconds for a free connection instead of forever. """
+    pool_timeout: float | None = None
+
+    def _get_conn(self, timeout: float | None = None):
+        return super()._get_conn(self.pool_timeout if timeout is None else timeout)
+
+
+class BlockingPoolAdapter(HTTPAdapter):
+    """ HTTPAdapter with blocking pools that give up after `pool_timeout`, raising `requests.ConnectionError`. """
+
+    def __init__(self, pool_timeout: float, **kwargs):
+        self.pool_timeout = pool_timeout  # Read by init_poolmanager, which the base constructor calls
+        super().__init__(pool_block = True, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http":  type("HTTPConnectionPool",  (PoolTimeout, HTTPConnectionPool),  {"pool_timeout": self.pool_timeout}),
+            "https": type("HTTPSConnectionPool", (PoolTimeout, HTTPSConnectionPool), {"pool_timeout": self.pool_timeout}),
+        }
+
+    def send(self, request, *args, **kwargs) -> requests.Response:
+        try:
+            return super().send(request, *args, **kwargs)
+        except EmptyPoolError as e:
+            raise requests.ConnectionError(e, request = request) from e
+
+
+def create_session(retries: int = RETRIES, backoff_factor: float = BACKOFF_FACTOR,
+                   pool_hosts: int = POOL_HOSTS, host_concurrency: int = HOST_CONCURRENCY, pool_timeout: float = POOL_TIMEOUT) -> requests.Session:
+    """ Create a session with keep-alive connection pools and bounded retries for idempotent requests. """
+    retry = Retry(
+        total = retries,
+        backoff_factor = backoff_factor,
+        status_forcelist = [429, 500, 502, 503, 504],
+        allowed_methods = ["GET", "HEAD"],
+        respect_retry_after_header = True,
+    )
+    adapter = BlockingPoolAdapter(pool_timeout, pool_connections = pool_hosts, pool_maxsize = host_concurrency, max_retries = retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(HEADERS)
+    # Bypass system proxy to avoid connection issues
+    session.trust_env = False
+    return session
+
+
+# Shared by every outbound fetch, so bursts of requests reuse pooled connections
+session = create_session()
+
+__all__ = ["create_session", "session"]
@@ -0,0 +1,212 @@
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+from typing import BinaryIO
+
+from app.app import IMAGE_CACHE_PATH, app
+from app.lib.image_download import ImageFetchError, open_image, save_image_stream
+
+CacheEntry = dict[str, str | int | float | None]
+
+
+class ImageCache:
+    """
+    Content-addressed on-disk cache for proxied images.
+    Entries are keyed by the SHA-256 of the URL, evicted least-recently-used once the cache
+    grows over `max_bytes`, and revalidated with ETag / Last-Modified once they expire.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._size = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._fetch_locks: dict[str, tuple[threading.Lock, int]] = {}  # URL key -> (lock, threads holding or waiting for it)
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _data_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _meta_path(self, key: str) -> str:
+        return self._data_path(key) + ".json"
+
+    def _load(self) -> None:
+        """ Rebuild the in-memory index from disk, oldest access first. Must hold `_lock`. """
+        if self._loaded: return
+        self._loaded = True
+        if not os.path.isdir(self.directory): return
+
+        found: list[tuple[float, CacheEntry]] = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"): continue
+                data_path = os.path.join(root, name[:-5])
+                try:
+                    with open(os.path.join(root, name), 'r', encoding = 'utf-8') as f:
+                        entry: CacheEntry = json.load(f)
+                    found.append((os.path.getmtime(data_path), entry))
+                except (OSError, ValueError):
+                    continue
+
+        for _, entry in sorted(found, key = lambda item: item[0]):
+            self._entries[str(entry["key"])] = entry
+            self._size += int(entry["size"] or 0)
+
+    def _fresh(self, entry: CacheEntry | None) -> bool:
+        return entry is not None and float(entry["expires_at"] or 0) > time.time()
+
+    def _touch(self, key: str) -> None:
+        """ Mark entry as most recently used. Must hold `_lock`. """
+        self._entries.move_to_end(key)
+        try:
+            os.utime(self._data_path(key))
+        except OSError:
+            pass
+
+    def _open(self, key: str) -> tuple[BinaryIO, CacheEntry] | None:
+        """ Open a cached file while holding `_lock`, so it cannot be evicted in between. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            try:
+                file = open(self._data_path(key), 'rb')
+            except OSError:
+                self._drop(key)
+                return None
+            self._touch(key)
+            return file, entry
+
+    def open(self, url: str) -> tuple[BinaryIO, CacheEntry]:
+        """
+        Return an open file and its cache entry for `url`.
+        Fresh entries are served without any outbound request; concurrent misses for the same URL
+        share a single upstream fetch.
+        """
+        key = self.key(url)
+
+        with self._lock:
+            self._load()
+            fresh = self._fresh(self._entries.get(key))
+
+        if fresh and (result := self._open(key)): return result
+
+        with self._lock:
+            fetch_lock, users = self._fetch_locks.get(key, (threading.Lock(), 0))
+            self._fetch_locks[key] = (fetch_lock, users + 1)
+
+        try:
+            with fetch_lock:
+                # Another request may have refreshed the entry while we were waiting
+                with self._lock:
+                    entry = self._entries.get(key)
+                if not self._fresh(entry) or not os.path.exists(self._data_path(key)):
+                    try:
+                        self._fetch(url, key, entry)
+                    except ImageFetchError:
+                        # Serve a stale copy rather than nothing if upstream is unavailable
+                        if entry is None: raise
+        finally:
+            # The lock stays shared until its last waiter is done, so no second fetch of the URL can start meanwhile
+            with self._lock:
+                fetch_lock, users = self._fetch_locks[key]
+                if users == 1: del self._fetch_locks[key]
+                else: self._fetch_locks[key] = (fetch_lock, users - 1)
+
+        result = self._open(key)
+        if result is None: raise ImageFetchError(f"Image could not be cached: {url}")
+        return result
+
+    def _fetch(self, url: str, key: str, entry: CacheEntry | None) -> None:
+        """ Download `url` into the cache, or revalidate `entry` if its file is still on disk """
+        headers: dict[str, str] = {}
+        # Without the cached file there is nothing a 304 could confirm, so that is a plain miss
+        if entry is not None and os.path.exists(self._data_path(key)):
+            if entry.get("etag"): headers['If-None-Match'] = str(entry["etag"])
+            if entry.get("last_modified"): headers['If-Modified-Since'] = str(entry["last_modified"])
+
+        with open_image(url, headers) as response:
+            expires_at = time.time() + self._max_age(response.headers.get('Cache-Control', ''))
+
+            if response.status_code == 304:
+                # A 304 has no body, so it must never be stored as the image
+                if entry is None or not headers: raise ImageFetchError(f"Upstream answered 304 to an unconditional request: {url}")
+                if os.path.exists(self._data_path(key)):
+                    entry["expires_at"] = expires_at
+                    self._write_meta(key, entry)
+                    return
+                evicted = True  # While the request was out; fetch it again in full
+            else:
+                evicted = False
+                size = save_image_stream(response, self._data_path(key))
+                new_entry: CacheEntry = {
+                    "key": key,
+                    "url": url,
+                    "size": size,
+                    "mimetype": response.headers.get('Content-Type', 'image/jpeg'),
+                    "etag": response.headers.get('ETag'),
+                    "last_modified": response.headers.get('Last-Modified'),
+                    "expires_at": expires_at,
+                }
+
+        if evicted: return self._fetch(url, key, None)
+        self._write_meta(key, new_entry)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None: self._size -= int(old["size"] or 0)
+            self._entries[key] = new_entry
+            self._size += size
+            self._evict()
+
+    def _max_age(self, cache_control: str) -> int:
+        if "no-store" in cache_control or "no-cache" in cache_control: return 0
+        # Photo URLs are immutable, so short upstream lifetimes are stretched to at least `ttl`
+        match = re.search(r'max-age=(\d+)', cache_control)
+        if match: return max(int(match.group(1)), self.ttl)
+        return self.ttl
+
+    def _write_meta(self, key: str, entry: CacheEntry) -> None:
+        meta_path = self._meta_path(key)
+        tmp_path = f"{meta_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, meta_path)
+
+    def _drop(self, key: str) -> None:
+        """ Remove an entry from the index and from disk. Must hold `_lock`. """
+        entry = self._entries.pop(key, None)
+        if entry is not None: self._size -= int(entry["size"] or 0)
+        for path in (self._data_path(key), self._meta_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _evict(self) -> None:
+        """ Drop least recently used entries until the cache fits. Must hold `_lock`. """
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            self._load()
+            return {"entries": len(self._entries), "size": self._size, "max_size": self.max_bytes}
+
+
+image_cache = ImageCache(IMAGE_CACHE_PATH, app.config["IMAGE_CACHE_MAX_BYTES"], app.config["IMAGE_CACHE_TTL"])
+
+__all__ = ["ImageCache", "image_cache"]
@@ -0,0 +1,95 @@
+
+import os
+import threading
+import requests
+
+from typing import Any, Iterator
+
+from app.app import app
+from app.lib.http_client import session
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageFetchError(Exception):
+    """ Raised when a remote URL cannot be fetched as an image. """
+
+
+def open_image(url: str, headers: dict[str, str] | None = None, max_bytes: int | None = None) -> requests.Response:
+    """
+    Start a streamed GET for `url` and validate it before any body is read.
+    The caller owns the returned response and must close it (it is usable as a context manager).
+    Upstream 304 responses are returned as-is so they can be used for revalidation.
+    """
+    max_bytes = max_bytes or app.config["IMAGE_MAX_BYTES"]
+
+    try:
+        response = session.get(url, timeout = 10, headers = headers, stream = True)
+    except requests.RequestException as e:
+        raise ImageFetchError(f"Failed to fetch image from URL: {str(e)}") from e
+
+    if response.status_code == 304: return response
+    try:
+        response.raise_for_status()
+    except requests.RequestException as e:
+        # Release the pooled connection before giving up on it
+        response.close()
+        raise ImageFetchError(f"Failed to fetch image from URL: {str(e)}") from e
+
+    content_type = response.headers.get('Content-Type', '')
+    if not content_type.startswith('image/'):
+        response.close()
+        raise ImageFetchError("URL does not point to a valid image.")
+
+    length = response.headers.get('Content-Length', '')
+    if length.isdigit() and int(length) > max_bytes:
+        response.close()
+        raise ImageFetchError(f"Image is too large (limit is {max_bytes // (1024 * 1024)} MB).")
+
+    return response
+
+
+def image_extension(response: requests.Response) -> str:
+    """ Return the file extension implied by the response content type, e.g. `jpeg` for `image/jpeg`. """
+    return response.headers.get('Content-Type', '').split(';')[0].strip().split('/')[-1].lower()
+
+
+def iter_image(response: requests.Response, max_bytes: int | None = None) -> Iterator[bytes]:
+    """ Yield the response body in fixed-size chunks, aborting once `max_bytes` is exceeded. """
+    max_bytes = max_bytes or app.config["IMAGE_MAX_BYTES"]
+    received = 0
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if not chunk: continue
+            received += len(chunk)
+            if received > max_bytes:
+                raise ImageFetchError(f"Image is too large (limit is {max_bytes // (1024 * 1024)} MB).")
+            yield chunk
+    except requests.RequestException as e:
+        raise ImageFetchError(f"Failed to fetch image from URL: {str(e)}") from e
+    finally:
+        response.close()
+
+
+def save_image_stream(response: requests.Response, path: str, max_bytes: int | None = None, digest: Any = None) -> int:
+    """
+    Stream the response body to `path` and return the number of bytes written.
+    Data is written to a temporary file first, so a failed or oversized download never leaves a partial image behind.
+    `digest` (e.g. `hashlib.sha256()`) is updated with every chunk, so the content is hashed without a second read.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    tmp_path = f"{path}.{threading.get_ident()}.part"
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter_image(response, max_bytes):
+                f.write(chunk)
+                if digest is not None: digest.update(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    return size
+
+
+__all__ = ["ImageFetchError", "open_image", "image_extension", "iter_image", "save_image_stream"]
@@ -0,0 +1,126 @@
+import os
+import hashlib
+import traceback
+
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from app.app import VALID_IMG_EXTENSIONS, app, db, encode_image, get_data
+from app.models import Draft, DraftImage
+from app.lib.presentation import get_free_filename
+from app.lib.image_download import ImageFetchError, image_extension, open_image, save_image_stream
+
+ProgressCallback = Callable[[int, int, str], None]
+
+
+def fetch_image(directory: str, url: str) -> tuple[str, str, int]:
+    """ Download an image into the directory; return its filename, SHA-256 and size """
+    response = open_image(url)
+    extension = image_extension(response)
+    if extension not in VALID_IMG_EXTENSIONS:
+        response.close()
+        raise ImageFetchError(f"Not a valid image extension: {extension}")
+
+    filename = get_free_filename(directory, extension, "img")
+    path = os.path.join(directory, filename)
+    digest = hashlib.sha256()
+    try:
+        size = save_image_stream(response, path, digest = digest)
+    except Exception:
+        os.remove(path)
+        raise
+    return filename, digest.hexdigest(), size
+
+
+class ExistingImages:
+    """ Content hashes of the draft's images, computed only for files whose size matches a download """
+
+    def __init__(self, directory: str, filenames: list[str]):
+        self.directory = directory
+        self.by_size: dict[int, list[str]] = {}
+        self.hashes: dict[str, str] = {}
+        for filename in filenames:
+            try:
+                self.by_size.setdefault(os.path.getsize(os.path.join(directory, filename)), []).append(filename)
+            except OSError:
+                continue
+
+    def find(self, sha: str, size: int) -> str | None:
+        for filename in self.by_size.get(size, []):
+            if filename not in self.hashes:
+                with open(os.path.join(self.directory, filename), 'rb') as f:
+                    self.hashes[filename] = hashlib.file_digest(f, "sha256").hexdigest()
+            if self.hashes[filename] == sha: return filename
+        return None
+
+
+def ingest_urls(draft: Draft, items: list[dict], on_progress: ProgressCallback | None = None) -> dict:
+    """
+    Download `{"url", "label"}` items into the draft through a bounded thread pool and add them in one commit.
+    Images with the same content as one already in the draft (or earlier in the batch) are not added twice.
+    Returns the added images and, per item index, the failures and duplicates.
+    """
+    draft_id = draft.id
+    directory = draft.path
+    existing_rows = db.session.execute(db.select(DraftImage.id, DraftImage.filename).where(DraftImage.draft_id == draft_id)).all()
+    existing = ExistingImages(directory, [row.filename for row in existing_rows])
+    existing_ids = {row.filename: row.id for row in existing_rows}
+    db.session.rollback()  # Hold no transaction open while downloading
+
+    # Each URL is downloaded once, however often it is listed
+    urls = list(dict.fromkeys(item["url"] for item in items))
+    downloads: dict[str, tuple[str, str, int] | str] = {}
+    done = 0
+    with ThreadPoolExecutor(max_workers = app.config["IMAGE_FETCH_WORKERS"]) as executor:
+        futures = {executor.submit(fetch_image, directory, url): url for url in urls}
+        for future in as_completed(futures):
+            try:
+                downloads[futures[future]] = future.result()
+            except ImageFetchError as e:
+                downloads[futures[future]] = str(e)
+            except Exception:
+                traceback.print_exc()
+                downloads[futures[future]] = "Failed to download image."
+            done += 1
+            if on_progress: on_progress(done, len(urls), f"Downloaded {done} of {len(urls)} images")
+
+    added: list[DraftImage] = []
+    failed: list[dict] = []
+    duplicates: list[dict] = []
+    kept: dict[str, DraftImage | str] = {}  # content hash -> image added in this batch, or filename of an existing one
+    for index, item in enumerate(items):
+        download = downloads[item["url"]]
+        if isinstance(download, str):
+            failed.append({"index": index, "url": item["url"], "error": download})
+            continue
+
+        filename, sha, size = download
+        if sha not in kept:
+            match = existing.find(sha, size)
+            if match is not None: kept[sha] = match
+        if sha in kept:
+            duplicates.append({"index": index, "url": item["url"], "duplicate_of": kept[sha]})
+            continue
+
+        image = DraftImage(draft_id, filename, presentation_n = -1, slide_n = 0, label = item.get("label", ""))
+        kept[sha] = image
+        added.append(image)
+
+    # Remove downloaded files whose content turned out to be a duplicate
+    used = {image.filename for image in added}
+    for download in downloads.values():
+        if not isinstance(download, str) and download[0] not in used and os.path.exists(os.path.join(directory, download[0])):
+            os.remove(os.path.join(directory, download[0]))
+
+    db.session.add_all(added)
+    db.session.flush()
+    for duplicate in duplicates:
+        of = duplicate["duplicate_of"]
+        duplicate["duplicate_of"] = of.hid() if isinstance(of, DraftImage) else encode_image(draft_id, existing_ids[of])
+    images = get_data(added)  # Before the commit expires them
+    db.session.commit()
+
+    return {"images": images, "failed": failed, "duplicates": duplicates}
+
+
+__all__ = ["fetch_image", "ingest_urls"]
@@ -1,18 +1,26 @@
 
-import os, re, time, requests
+import os, re, time, asyncio
 from typing import Iterator
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+
+from app.app import INAT_CACHE_DB
+from app.lib.http_client import session
+from app.lib.query_cache import QueryCache
+from app.lib.rate_limit import create_token_bucket
 
 PER_PAGE = 100
-RATE_LIMIT_DELAY = 0.2  # Delay between API requests in seconds
-rate_limit_lock = threading.Lock()
-last_request_time = 0
+MAX_WORKERS = 16
+RATE_LIMIT = float(os.environ.get("INAT_RATE_LIMIT", 1.0))  # API requests per second, shared by all threads
+RATE_LIMIT_BURST = int(os.environ.get("INAT_RATE_LIMIT_BURST", 5))
+RATE_LIMIT_DB = os.environ.get("INAT_RATE_LIMIT_DB")  # SQLite file to share the quota between processes
+
+CACHE_TTL = float(os.environ.get("INAT_CACHE_TTL", 24 * 3600))  # Seconds a cached page is served as fresh
+CACHE_STALE_TTL = float(os.environ.get("INAT_CACHE_STALE_TTL", 7 * 24 * 3600))  # Further seconds it is served while refreshing
 
-# Create session with proxy bypass to avoid proxy connection issues
-session = requests.Session()
-session.proxies = {}  # Bypass system proxy
-session.headers.update({'User-Agent': 'Recognify'})
+page_cache = QueryCache(INAT_CACHE_DB, CACHE_TTL, CACHE_STALE_TTL)
+rate_limiter = create_token_bucket(RATE_LIMIT, RATE_LIMIT_BURST, RATE_LIMIT_DB, "inaturalist")
+# Blocking page requests of the async engine run here, so each event loop doesn't spin up its own threads
+page_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="inat")
 
 def clean(name: str) -> str:
     return re.sub(r'[^0-9A-Za-zčřžýáíéúůťďň _.-]', '_', name)[:160]
@@ -32,41 +40,77 @@ def img_candidates(url: str) -> list[str]:
     candidates.extend([u, url])
     return list(dict.fromkeys(filter(None, candidates)))
 
-def get_page(query: str, page_i: int) -> list[dict]:
-    params = {"q": query, "quality_grade": "research", "photos": "true", "per_page": PER_PAGE, "page": page_i+1}
-    r = session.get("https://api.inaturalist.org/v1/observations", params = params, timeout = 20)
+def page_params(query: str, page_i: int) -> dict[str, str | int]:
+    return {"q": query, "quality_grade": "research", "photos": "true", "per_page": PER_PAGE, "page": page_i+1}
+
+def request_page(query: str, page_i: int) -> list[dict]:
+    r = session.get("https://api.inaturalist.org/v1/observations", params = page_params(query, page_i), timeout = 20)
     r.raise_for_status()
 
     res: list[dict] = r.json().get("results", [])
     return res
 
+def fetch_page(query: str, page_i: int) -> list[dict]:
+    rate_limiter.acquire()
+    return request_page(query, page_i)
+
+def get_page(query: str, page_i: int) -> list[dict]:
+    key = QueryCache.key("observations", page_params(query, page_i))
+    return page_cache.get(key, lambda: fetch_page(query, page_i))
+
+async def get_page_async(query: str, page_i: int) -> list[dict]:
+    key = QueryCache.key("observations", page_params(query, page_i))
+    cached = page_cache.lookup(key, lambda: fetch_page(query, page_i))
+    if cached is not None: return cached
+
+    await rate_limiter.acquire_async()
+    page = await asyncio.get_running_loop().run_in_executor(page_executor, request_page, query, page_i)
+    page_cache.store(key, page)
+    return page
+
+def page_links(page: list[dict], limit: int) -> list[str]:
+    """ Return up to `limit` best-quality photo URLs from a page of observations. """
+    image_links: list[str] = []
+    for observation in page:
+        for photo in observation.get("photos", []):
+            if len(image_links) >= limit: return image_links
+            base_url: str = photo.get("url", "")
+            if base_url:
+                # Use img_candidates to get best quality URL (converts square→original/large)
+                candidates = img_candidates(base_url)
+                if candidates:
+                    image_links.append(candidates[0])
+    return image_links
+
 def get_image_links(species: str, max_images: int) -> list[str]:
     print(f"[iNat] Fetching images for '{species}'...")
     image_links: list[str] = []
-    saved = 0
     page_i = 0
     
-    while saved < max_images:
+    while len(image_links) < max_images:
         page = get_page(species, page_i)
         if not page: 
-            print(f"[iNat] No more results for '{species}' (got {saved}/{max_images} images)")
+            print(f"[iNat] No more results for '{species}' (got {len(image_links)}/{max_images} images)")
             break
 
-        for observation in page:
-            if saved >= max_images: break
-            for photo in observation.get("photos", []):
-                if saved >= max_images: break
-                base_url: str = photo.get("url", "")
-                if base_url:
-                    # Use img_candidates to get best quality URL (converts square→original/large)
-                    candidates = img_candidates(base_url)
-                    if candidates:
-                        image_links.append(candidates[0])
-                        saved += 1
+        image_links.extend(page_links(page, max_images - len(image_links)))
         page_i += 1
     
     return image_links
 
+async def get_image_links_async(species: str, max_images: int) -> list[str]:
+    image_links: list[str] = []
+    page_i = 0
+
+    while len(image_links) < max_images:
+        page = await get_page_async(species, page_i)
+        if not page: break
+
+        image_links.extend(page_links(page, max_images - len(image_links)))
+        page_i += 1
+
+    return image_links
+
 def download_photos(query: str, max_img: int, output: str) -> None:
     links = get_image_links(query, max_img)
     with ThreadPoolExecutor(max_workers=4) as executor:
@@ -87,17 +131,17 @@ def download_photo(photo: dict, obs_id: int, downloaded: int, output: str) -> bo
 
 def download_candidate(candidate_url: str, output: str, obs_id: int, downloaded: int) -> bool:
     try:
-        response = session.get(candidate_url, stream=True, timeout=20, proxies={})
-        if response.status_code != 200: return False
-        if not response.headers.get("content-type", "").startswith("image"): return False
+        with session.get(candidate_url, stream=True, timeout=20) as response:
+            if response.status_code != 200: return False
+            if not response.headers.get("content-type", "").startswith("image"): return False
 
-        extension = (response.headers.get("content-type", "")).split("/")[-1].split(";")[0]
-        if extension == "jpeg": extension = "jpg"
+            extension = (response.headers.get("content-type", "")).split("/")[-1].split(";")[0]
+            if extension == "jpeg": extension = "jpg"
 
-        filename = f"inat_{obs_id}_{downloaded:03d}.{extension}"
-        path = os.path.join(output, filename)
-        write_file(response.iter_content(1024*16), path)
-        return True
+            filename = f"inat_{obs_id}_{downloaded:03d}.{extension}"
+            path = os.path.join(output, filename)
+            write_file(response.iter_content(1024*16), path)
+            return True
     except Exception:
         return False
 
@@ -112,11 +156,12 @@ def get_inaturalist_image_links(species_list: list[str], max_images_per_species:
     
     Args:
         species_list: List of species names
-        max_images_per_species: Maximum images per species (default 2 to avoid rate limiting)
+        max_images_per_species: Maximum images per species (default 8)
     """
     image_sets: list[dict] = []
-    # Reduce to 2 workers to respect iNaturalist rate limiting (0.2s minimum between requests)
-    with ThreadPoolExecutor(max_workers=2) as executor:
+    if not species_list: return image_sets
+    # Request rate is bounded by `rate_limiter`, so the pool only needs to be large enough to keep it busy
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(species_list))) as executor:
         futures = {executor.submit(get_image_links, species, max_images_per_species): species for species in species_list}
         completed = 0
         for future in futures:
@@ -128,4 +173,25 @@ def get_inaturalist_image_links(species_list: list[str], max_images_per_species:
     print(f"[iNat] Finished! Total: {len(image_sets)} species with {sum(len(item['urls']) for item in image_sets)} images")
     return image_sets
 
-__all__ = ["download_photos", "get_inaturalist_image_links"]
+async def get_inaturalist_image_links_async(species_list: list[str], max_images_per_species: int = 8, timeout: float | None = None) -> list[dict[str, str | list[str]]]:
+    """Get image URLs from iNaturalist for multiple species, fetching all species concurrently.
+    
+    Same result as `get_inaturalist_image_links`. Pages are still requested under `rate_limiter`.
+    If the timeout expires or the caller is cancelled, no further pages are requested.
+
+    Args:
+        species_list: List of species names
+        max_images_per_species: Maximum images per species (default 8)
+        timeout: Seconds to wait for all species before giving up (default no limit)
+    """
+    tasks = [asyncio.create_task(get_image_links_async(species, max_images_per_species)) for species in species_list]
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+    finally:
+        for task in tasks: task.cancel()
+
+    image_sets: list[dict] = [{"species": species, "urls": urls} for species, urls in zip(species_list, results)]
+    print(f"[iNat] Finished! Total: {len(image_sets)} species with {sum(len(item['urls']) for item in image_sets)} images")
+    return image_sets
+
+__all__ = ["download_photos", "get_inaturalist_image_links", "get_inaturalist_image_links_async", "page_cache"]
@@ -0,0 +1,243 @@
+
+import os
+import json
+import time
+import asyncio
+import datetime
+import threading
+import traceback
+
+from typing import Any, Callable
+from sqlalchemy import delete, inspect, select, update
+
+from app.app import EXPORT_PATH, app, db, encode, get_data, log_info
+from app.models import Draft, DraftImage, DraftLabel, Job
+from app.lib.export import export_draft, import_draft_from_path
+from app.lib.presentation import extract_images_from_path, temp_remove
+from app.lib.image_ingest import ingest_urls
+from app.lib.inaturalist_api import get_inaturalist_image_links, get_inaturalist_image_links_async
+
+POLL_INTERVAL = 2.0     # Seconds between queue checks when no job was announced
+SWEEP_INTERVAL = 3600.0  # Seconds between retention sweeps
+
+
+class JobError(Exception):
+    """ Raised by a job handler to fail the job with a user-facing message. """
+
+
+class JobContext:
+    """ Handed to job handlers to report progress. Updates are written outside the handler's session. """
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+
+    def progress(self, done: float, total: float = 1, message: str = "") -> None:
+        fraction = min(1.0, done / total) if total else 0.0
+        with db.engine.begin() as conn:
+            conn.execute(update(Job).where(Job.id == self.job_id).values(
+                progress = fraction, message = message[:256], updated_at = datetime.datetime.utcnow()
+            ))
+
+
+JobHandler = Callable[[dict[str, Any], JobContext], dict[str, Any]]
+handlers: dict[str, JobHandler] = {}
+
+
+def job_handler(kind: str) -> Callable[[JobHandler], JobHandler]:
+    """ Register a function as the handler for jobs of the given kind. """
+    def decorator(func: JobHandler) -> JobHandler:
+        handlers[kind] = func
+        return func
+    return decorator
+
+
+class WorkerPool:
+    """ Threads that claim queued jobs from the database and run their handlers. """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._threads: list[threading.Thread] = []
+        self._wakeup = threading.Condition()
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+
+    def start(self) -> None:
+        with self._lock:
+            if self._threads: return
+            with app.app_context():
+                abandoned = fail_abandoned()
+            if abandoned: log_info(f"Failed {abandoned} jobs left running by a previous process")
+            for i in range(self.workers):
+                thread = threading.Thread(target = self._run, name = f"job-worker-{i}", daemon = True)
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self) -> None:
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                with app.app_context():
+                    job_id = self._claim()
+                    if job_id is not None:
+                        self._execute(job_id)
+                        continue
+            except Exception:
+                # Keep the worker alive, e.g. when the database is briefly locked
+                traceback.print_exc()
+
+            self._sweep_if_due()
+            with self._wakeup:
+                self._wakeup.wait(POLL_INTERVAL)
+
+    def _sweep_if_due(self) -> None:
+        """ Run the retention sweep on one idle worker at most every `SWEEP_INTERVAL` seconds. """
+        with self._lock:
+            if time.monotonic() < self._next_sweep: return
+            self._next_sweep = time.monotonic() + SWEEP_INTERVAL
+        try:
+            with app.app_context():
+                jobs, files = sweep()
+            if jobs or files: log_info(f"Removed {jobs} finished jobs and {files} export files past retention")
+        except Exception:
+            traceback.print_exc()
+
+    def _claim(self) -> int | None:
+        """ Atomically move the oldest queued job to running and return its ID. """
+        while True:
+            job_id = db.session.execute(select(Job.id).where(Job.status == Job.QUEUED).order_by(Job.id).limit(1)).scalar()
+            if job_id is None: return None
+
+            claimed = db.session.execute(update(Job).where(Job.id == job_id, Job.status == Job.QUEUED).values(
+                status = Job.RUNNING, updated_at = datetime.datetime.utcnow()
+            )).rowcount
+            db.session.commit()
+            if claimed: return job_id
+
+    def _execute(self, job_id: int) -> None:
+        job = db.session.get(Job, job_id)
+        if not isinstance(job, Job): return
+
+        handler = handlers.get(job.kind)
+        try:
+            if handler is None: raise JobError(f"Unknown job kind '{job.kind}'.")
+            result = handler(json.loads(job.payload), JobContext(job.id))
+            status, message = Job.DONE, ""
+        except Exception as e:
+            db.session.rollback()
+            if not isinstance(e, JobError): traceback.print_exc()
+            result, status, message = None, Job.FAILED, str(e) or type(e).__name__
+            log_info(f"Job {job_id} ({job.kind}) failed: {message}")
+
+        job = db.session.get(Job, job_id)
+        if not isinstance(job, Job): return
+        job.status = status
+        job.message = message[:256]
+        job.result = json.dumps(result) if result is not None else None
+        if status == Job.DONE: job.progress = 1
+        db.session.commit()
+
+
+def fail_abandoned() -> int:
+    """
+    Fail running jobs whose worker died with its process. Only jobs without an update for `JOB_STALE_AFTER`
+    seconds count, since other processes share the queue and may still be running theirs.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds = app.config["JOB_STALE_AFTER"])
+    failed = db.session.execute(update(Job).where(Job.status == Job.RUNNING, Job.updated_at < cutoff).values(
+        status = Job.FAILED, message = "Interrupted by a restart, please try again.", updated_at = datetime.datetime.utcnow()
+    )).rowcount
+    db.session.commit()
+    return failed
+
+
+def sweep() -> tuple[int, int]:
+    """ Delete finished jobs and export files older than `JOB_RETENTION` seconds; return how many of each. """
+    retention = app.config["JOB_RETENTION"]
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds = retention)
+    jobs = db.session.execute(delete(Job).where(Job.status.in_([Job.DONE, Job.FAILED]), Job.updated_at < cutoff)).rowcount
+    db.session.commit()
+
+    # Exports (and imports whose job never ran) are only reachable through a job, so they age out with it
+    files = 0
+    if os.path.isdir(EXPORT_PATH):
+        expired = time.time() - retention
+        for entry in os.scandir(EXPORT_PATH):
+            if entry.is_file() and entry.stat().st_mtime < expired:
+                os.remove(entry.path)
+                files += 1
+    return jobs, files
+
+
+pool = WorkerPool(app.config["JOB_WORKERS"])
+
+
+def enqueue(kind: str, payload: dict[str, Any], user_id: int | None = None) -> Job:
+    """ Queue a job for background processing and return it. """
+    job = Job(kind, json.dumps(payload), user_id)
+    db.session.add(job)
+    db.session.commit()
+
+    pool.start()
+    pool.notify()
+    return job
+
+
+@job_handler("presentation")
+def presentation_job(payload: dict[str, Any], context: JobContext) -> dict[str, Any]:
+    try:
+        result = extract_images_from_path(payload["path"], payload["draft_id"], lambda done, total: context.progress(done, total))
+    finally:
+        temp_remove(payload["path"])
+    if not result: raise JobError("Failed to process presentation.")
+
+    images, labels = result
+    log_info(f"Extracted {len(images)} images from presentation for draft {payload['draft_id']}")
+    # The import's commit expired every row; reload them with one query per table instead of one per row
+    for model, rows in ((DraftImage, images), (DraftLabel, labels)):
+        if rows: db.session.scalars(select(model).where(model.id.in_([inspect(row).identity[0] for row in rows]))).all()
+    # Images already carry the labels matched from their slides, so the editor can show them without reconciling
+    return {"images": get_data(images), "labels": get_data(labels), "matched": sum(1 for image in images if image.label)}
+
+
+@job_handler("image_urls")
+def image_urls_job(payload: dict[str, Any], context: JobContext) -> dict[str, Any]:
+    draft = db.session.get(Draft, payload["draft_id"])
+    if not isinstance(draft, Draft): raise JobError("Draft not found.")
+
+    result = ingest_urls(draft, payload["images"], lambda done, total, message: context.progress(done, total, message))
+    log_info(f"Added {len(result['images'])} of {len(payload['images'])} images from URLs to draft {draft.id}, {len(result['failed'])} failed")
+    return result
+
+
+@job_handler("export_draft")
+def export_draft_job(payload: dict[str, Any], context: JobContext) -> dict[str, Any]:
+    draft = db.session.get(Draft, payload["draft_id"])
+    if not isinstance(draft, Draft): raise JobError("Draft not found.")
+
+    filename = export_draft(draft)
+    if filename == False: raise JobError("Failed to export draft.")
+    return {"file": filename, "download_name": "export.zip"}
+
+
+@job_handler("import_draft")
+def import_draft_job(payload: dict[str, Any], context: JobContext) -> dict[str, Any]:
+    draft_id = import_draft_from_path(payload["path"], payload["owner_id"])
+    if not draft_id: raise JobError("Failed to import draft.")
+    return {"draft_id": encode(draft_id)}
+
+
+@job_handler("inaturalist_links")
+def inaturalist_links_job(payload: dict[str, Any], context: JobContext) -> dict[str, Any]:
+    species_list: list[str] = payload["species"]
+    if app.config["INAT_ENGINE"] == "async":
+        links = asyncio.run(get_inaturalist_image_links_async(species_list, timeout = app.config["INAT_TIMEOUT"]))
+    else:
+        links = get_inaturalist_image_links(species_list)
+    log_info(f"Successfully fetched links for {len(links)} species")
+    return {"links": links}
+
+
+__all__ = ["JobError", "JobContext", "job_handler", "enqueue", "pool"]
@@ -0,0 +1,160 @@
+from sqlalchemy import delete, event, func, insert, inspect, select
+
+from app.app import db, encode, encode_image, log_info
+from app.models import Draft, DraftAccess, DraftImage, Image, LabelTerm, Set
+from app.lib.search_index import tokenize
+
+TERM_LENGTH = 128
+# Upper bound for prefix ranges: `term >= q AND term < q + PREFIX_END` can use the term index, LIKE cannot
+PREFIX_END = "\U0010ffff"
+
+
+def label_terms(label: str | None) -> set[str]:
+    """
+    Normalized terms a label can be found by: the whole label, every word and every trailing phrase,
+    all lowercase without diacritics. Latin binomials are also indexed with an abbreviated genus,
+    so 'Parus major' is found by 'parus ma', 'major' and 'P. major'.
+    """
+    words = tokenize(label or "")
+    if not words: return set()
+
+    terms = set(words) | {" ".join(words[i:]) for i in range(len(words))}
+    if len(words) in (2, 3) and all(word.isalpha() for word in words) and len(words[0]) > 1:
+        terms.add(" ".join([words[0][0], *words[1:]]))
+    return {term[:TERM_LENGTH] for term in terms}
+
+def normalize_query(query: str) -> str:
+    return " ".join(tokenize(query))[:TERM_LENGTH]
+
+
+def term_rows(obj: Image | DraftImage) -> list[dict]:
+    if isinstance(obj, Image):
+        return [{"term": term, "image_id": obj.id, "set_id": obj.set_id} for term in label_terms(obj.label)]
+    return [{"term": term, "draft_image_id": obj.id, "draft_id": obj.draft_id} for term in label_terms(obj.label)]
+
+
+def is_reindexed(obj: Image | DraftImage) -> bool:
+    state = inspect(obj)
+    keys = ("label", "set_id") if isinstance(obj, Image) else ("label", "draft_id")
+    return any(state.attrs[key].history.has_changes() for key in keys)
+
+
+@event.listens_for(db.session, "after_flush")
+def sync_label_terms(session, flush_context) -> None:
+    """ Re-index images whose label was added, changed or deleted, in the same transaction """
+    changed = [obj for obj in session.new if isinstance(obj, (Image, DraftImage))]
+    changed += [obj for obj in session.dirty if isinstance(obj, (Image, DraftImage)) and is_reindexed(obj)]
+    removed = [obj for obj in session.deleted if isinstance(obj, (Image, DraftImage))]
+    if not changed and not removed: return
+
+    conn = session.connection()
+    stale_images       = [obj.id for obj in changed + removed if isinstance(obj, Image)]
+    stale_draft_images = [obj.id for obj in changed + removed if isinstance(obj, DraftImage)]
+    if stale_images:       conn.execute(delete(LabelTerm).where(LabelTerm.image_id.in_(stale_images)))
+    if stale_draft_images: conn.execute(delete(LabelTerm).where(LabelTerm.draft_image_id.in_(stale_draft_images)))
+
+    rows = [row for obj in changed for row in term_rows(obj)]
+    if rows: conn.execute(insert(LabelTerm), rows)
+
+
+def remove_sets(set_id: int | None = None) -> None:
+    """ Drop terms of images removed by a bulk delete, which skips `sync_label_terms`; None drops all sets """
+    db.session.execute(delete(LabelTerm).where(LabelTerm.image_id != None, *([LabelTerm.set_id == set_id] if set_id is not None else [])))
+
+def remove_drafts(draft_id: int | None = None) -> None:
+    db.session.execute(delete(LabelTerm).where(LabelTerm.draft_image_id != None, *([LabelTerm.draft_id == draft_id] if draft_id is not None else [])))
+
+def reindex_images(removed: list[int], images: list[tuple[int, int, str | None]]) -> None:
+    """ Drop terms of removed images and re-index (id, set_id, label) rows written by bulk statements """
+    stale = removed + [image_id for image_id, _, _ in images]
+    if stale: db.session.execute(delete(LabelTerm).where(LabelTerm.image_id.in_(stale)))
+    rows = [{"term": term, "image_id": image_id, "set_id": set_id} for image_id, set_id, label in images for term in label_terms(label)]
+    if rows: db.session.execute(insert(LabelTerm), rows)
+
+
+def rebuild() -> None:
+    """ Runs on import (see `init`), possibly before `flask db upgrade`, so it reads only columns every schema version has """
+    db.session.execute(delete(LabelTerm))
+    rows = [
+        {"term": term, "image_id": image_id, "set_id": set_id}
+        for image_id, set_id, label in db.session.execute(select(Image.id, Image.set_id, Image.label).where(Image.label != None)).all()
+        for term in label_terms(label)
+    ]
+    rows += [
+        {"term": term, "draft_image_id": image_id, "draft_id": draft_id}
+        for image_id, draft_id, label in db.session.execute(select(DraftImage.id, DraftImage.draft_id, DraftImage.label).where(DraftImage.label != None)).all()
+        for term in label_terms(label)
+    ]
+    if rows: db.session.execute(insert(LabelTerm), rows)
+    db.session.commit()
+    log_info(f"Label index rebuilt with {len(rows)} terms")
+
+def init() -> None:
+    """ Fill the index on first start, when images exist but no terms do. Call inside an app context. """
+    if db.session.execute(select(LabelTerm.id).limit(1)).first() is not None: return
+    if db.session.execute(select(Image.id).limit(1)).first() is None and db.session.execute(select(DraftImage.id).limit(1)).first() is None: return
+    rebuild()
+
+
+def search(query: str, user, limit: int = 10, images_per_result: int = 20) -> dict[str, list[dict]]:
+    """
+    Sets (visible to the user) and drafts (the user can edit) with images whose label matches the query as a prefix,
+    most matching images first, each with the count and the hashes of matching images.
+    """
+    q = normalize_query(query)
+    if not q: return {"sets": [], "drafts": []}
+    matches = (LabelTerm.term >= q) & (LabelTerm.term < q + PREFIX_END)
+
+    visible_sets = Set.visible_to(user).with_entities(Set.id)
+    set_counts = db.session.execute(
+        select(LabelTerm.set_id, func.count(LabelTerm.image_id.distinct()).label("n"))
+        .where(matches, LabelTerm.image_id != None, LabelTerm.set_id.in_(visible_sets))
+        .group_by(LabelTerm.set_id).order_by(func.count(LabelTerm.image_id.distinct()).desc(), LabelTerm.set_id).limit(limit)
+    ).all()
+
+    draft_counts = []
+    if user is not None and user.is_authenticated:
+        editable = select(Draft.id).outerjoin(DraftAccess, Draft.id == DraftAccess.draft_id)\
+            .where((Draft.owner_id == user.id) | (DraftAccess.user_id == user.id))
+        draft_counts = db.session.execute(
+            select(LabelTerm.draft_id, func.count(LabelTerm.draft_image_id.distinct()).label("n"))
+            .where(matches, LabelTerm.draft_image_id != None, LabelTerm.draft_id.in_(editable))
+            .group_by(LabelTerm.draft_id).order_by(func.count(LabelTerm.draft_image_id.distinct()).desc(), LabelTerm.draft_id).limit(limit)
+        ).all()
+
+    set_images: dict[int, list[str]] = {set_id: [] for set_id, _ in set_counts}
+    if set_images:
+        for set_id, image_id in db.session.execute(select(LabelTerm.set_id, LabelTerm.image_id).distinct()
+                                                   .where(matches, LabelTerm.set_id.in_(set_images), LabelTerm.image_id != None)
+                                                   .order_by(LabelTerm.set_id, LabelTerm.image_id)).all():
+            if len(set_images[set_id]) < images_per_result: set_images[set_id].append(encode_image(set_id, image_id))
+
+    draft_images: dict[int, list[str]] = {draft_id: [] for draft_id, _ in draft_counts}
+    if draft_images:
+        for draft_id, image_id in db.session.execute(select(LabelTerm.draft_id, LabelTerm.draft_image_id).distinct()
+                                                     .where(matches, LabelTerm.draft_id.in_(draft_images), LabelTerm.draft_image_id != None)
+                                                     .order_by(LabelTerm.draft_id, LabelTerm.draft_image_id)).all():
+            if len(draft_images[draft_id]) < images_per_result: draft_images[draft_id].append(encode_image(draft_id, image_id))
+
+    set_names = dict(db.session.execute(select(Set.id, Set.name).where(Set.id.in_(set_images))).all()) if set_images else {}
+    draft_names = dict(db.session.execute(select(Draft.id, Draft.name).where(Draft.id.in_(draft_images))).all()) if draft_images else {}
+
+    return {
+        "sets": [{
+            "id": encode(set_id),
+            "name": set_names.get(set_id, ""),
+            "url": f"/sets/{encode(set_id)}",
+            "count": count,
+            "images": set_images[set_id],
+        } for set_id, count in set_counts],
+        "drafts": [{
+            "id": encode(draft_id),
+            "name": draft_names.get(draft_id, ""),
+            "url": f"/draft/{encode(draft_id)}",
+            "count": count,
+            "images": draft_images[draft_id],
+        } for draft_id, count in draft_counts],
+    }
+
+
+__all__ = ["label_terms", "normalize_query", "search", "rebuild", "init", "remove_sets", "remove_drafts", "reindex_images"]
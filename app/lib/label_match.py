@@ -0,0 +1,78 @@
+from sqlalchemy import select
+
+from app.app import db
+from app.models import DraftImage, DraftLabel
+from app.lib.search_index import tokenize
+
+# Keys shorter than this are never corrected, one edit changes too much of them
+MIN_TYPO_LENGTH = 8
+
+
+def label_key(label: str) -> str:
+    return " ".join(tokenize(label))
+
+
+def within_one_edit(a: str, b: str) -> bool:
+    """ Whether one insertion, deletion or substitution turns `a` into `b` """
+    if abs(len(a) - len(b)) > 1: return False
+    if len(a) > len(b): a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]: i += 1
+    if len(a) == len(b): return a[i + 1:] == b[i + 1:]
+    return a[i:] == b[i + 1:]
+
+
+class KnownLabels:
+    """
+    Labels already used in the draft, looked up by normalized form. Close species names differ by a few letters
+    ('Calidris alba', 'Calidris alpina'), so the only approximate match is a single typo against a label the draft
+    already had before the import.
+    """
+
+    def __init__(self, labels: list[str]):
+        self.by_key: dict[str, str] = {}
+        for label in labels:
+            self.by_key.setdefault(label_key(label), label)
+        self.existing = dict(self.by_key)
+
+    def resolve(self, label: str) -> str:
+        key = label_key(label)
+        if not key: return label
+        if key in self.by_key: return self.by_key[key]
+
+        if len(key) >= MIN_TYPO_LENGTH:
+            typos = [existing for existing in self.existing if within_one_edit(key, existing)]
+            if len(typos) == 1: return self.existing[typos[0]]
+        self.by_key[key] = label  # Later images of the same import reuse this spelling
+        return label
+
+
+def slide_pairs(images: list[DraftImage], labels: list[DraftLabel]) -> list[tuple[DraftImage, DraftLabel]]:
+    """ Pair a slide's images with its labels in document order; a slide whose counts differ is left to the editor """
+    if not labels or len(images) != len(labels): return []
+    return list(zip(images, labels))
+
+
+def assign_labels(draft_id: int, images: list[DraftImage], labels: list[DraftLabel]) -> int:
+    """
+    Label unlabelled images of an import from the text on their slide, before they are inserted.
+    Labels are normalized to the spelling already used in the draft. Returns the number of images labelled.
+    """
+    by_slide: dict[int, tuple[list[DraftImage], list[DraftLabel]]] = {}
+    for image in images:
+        if not image.label: by_slide.setdefault(image.slide, ([], []))[0].append(image)
+    for label in labels:
+        if label.slide in by_slide: by_slide[label.slide][1].append(label)
+
+    pairs = [pair for slide_images, slide_labels in by_slide.values() for pair in slide_pairs(slide_images, slide_labels)]
+    if not pairs: return 0
+
+    known = KnownLabels(list(db.session.execute(
+        select(DraftImage.label).distinct().where(DraftImage.draft_id == draft_id, DraftImage.label != None, DraftImage.label != "")
+    ).scalars()))
+    for image, label in pairs:
+        image.label = known.resolve(label.label)
+    return len(pairs)
+
+
+__all__ = ["KnownLabels", "assign_labels"]
@@ -1,18 +1,38 @@
 
+import re
 import os.path
-
-from typing import Literal
+import zipfile
+import threading
+import hashlib
+import tempfile
+import posixpath
+
+from typing import Callable, Iterable, Iterator, Literal
+from concurrent.futures import Future, ThreadPoolExecutor
+from xml.etree import ElementTree
 from werkzeug.datastructures import FileStorage
-from pptx.enum.shapes import MSO_SHAPE_TYPE as SHAPE_TYPE
-from pptx.shapes.picture import Picture as PPTXPicture
-from pptx import Presentation
 
-from app.app import UPLOAD_PATH, hid
+from app.app import UPLOAD_PATH, log_info
 from app.models import Draft, DraftImage, DraftLabel, db
+from app.lib.label_match import assign_labels
 
 TEMP_UPLOAD_PATH = os.path.join(UPLOAD_PATH, "temp")
+IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff']
+MEDIA_CHUNK_SIZE = 64 * 1024
+IMPORT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Next filename index per (directory, prefix), see `get_free_filename`
+filename_counters: dict[tuple[str, str], int] = {}
+filename_lock = threading.Lock()
+
+NS_P = "http://schemas.openxmlformats.org/presentationml/2006/main"
+NS_A = "http://schemas.openxmlformats.org/drawingml/2006/main"
+NS_R = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+NS_PACKAGE_RELS = "http://schemas.openxmlformats.org/package/2006/relationships"
 
 SlideItem = dict[str, str]
+ProgressCallback = Callable[[int, int], None]
+MediaFile = tuple[str, str, str]  # (temporary path, extension, content hash)
 
 
 
@@ -28,16 +48,15 @@ def create_draft() -> int:
         raise e
 
 
-def extract_images(presentation_file: FileStorage, draft_id: int) -> tuple[str, list[DraftImage], list[DraftLabel]] | Literal[False]:
+def extract_images_from_path(address: str, draft_id: int, on_progress: ProgressCallback | None = None) -> tuple[list[DraftImage], list[DraftLabel]] | Literal[False]:
     """
-    Extract images and text labels from a presentation file and save them to the database.
-    Returns a tuple containing the temporary presentation file address, a list of image filenames with slide numbers,
-    and a list of text labels with slide numbers.
+    Extract images and text labels from a presentation file already saved at `address`.
+    The PPTX archive is read part by part: slides are parsed one at a time on this thread while a pool of
+    `IMPORT_WORKERS` threads streams media to the draft directory, so memory use does not grow with the size of the deck.
+    Media used on several slides are stored once, on the first slide they appear on. Images are labelled from
+    their slide's text where that is unambiguous (see `assign_labels`), then all rows are inserted together at the end.
+    `on_progress` is called with the number of processed and total slides after each slide.
     """
-    address = temp_save(presentation_file)
-    if not address: return False
-
-    pres = Presentation(address)
     draft = Draft.query.get(draft_id)
     if not isinstance(draft, Draft): return False
     pres_n = draft.presentations
@@ -45,37 +64,164 @@ def extract_images(presentation_file: FileStorage, draft_id: int) -> tuple[str,
     labels: list[DraftLabel] = []
     images: list[DraftImage] = []
 
+    try:
+        pres = zipfile.ZipFile(address)
+    except zipfile.BadZipFile:
+        return False
+
+    pending: list[tuple[int, Future[MediaFile | None]]] = []  # (slide number, extraction) in document order
+    failed = False
+    with pres, ThreadPoolExecutor(max_workers = IMPORT_WORKERS) as executor:
+        try:
+            slides = slide_parts(pres)
+            submitted: set[str] = set()
+            for slide_n, slide_part in enumerate(slides):
+                for kind, value in slide_shapes(pres, slide_part):
+                    if kind == "image":
+                        if value in submitted: continue
+                        submitted.add(value)
+                        pending.append((slide_n, executor.submit(extract_media, address, value, draft.path)))
+                    else:
+                        labels.extend(parse_labels(value, pres_n, slide_n, draft_id))
+
+                if on_progress is not None: on_progress(slide_n + 1, len(slides))
+        except (KeyError, ElementTree.ParseError):
+            for _, future in pending: future.cancel()
+            failed = True
+
+    if failed:
+        # The executor has finished the extractions that could not be cancelled
+        discard_media(future for _, future in pending)
+        return False
+
+    digests: set[str] = set()
     image_n = 1
-    for slide_n, slide in enumerate(pres.slides):
-        for shape in slide.shapes:
-            slide_encoded = hid.encode(pres_n * 10_000 + slide_n)
-            if not isinstance(slide_encoded, str): slide_encoded = str(pres_n * 10_000 + slide_n)
-
-            if shape.shape_type == SHAPE_TYPE.PICTURE:
-                if not isinstance(shape, PPTXPicture): continue
-                image = shape.image
-                try:
-                    filename = save_image(image.blob, image.ext, draft.path, start=image_n)
-                except Exception:
-                    filename = False
-                if not filename: continue
-                print(f"Saved image {filename} from slide {slide_n + 1}")
-                draft_img = DraftImage(draft_id, filename, pres_n, slide_n, label = "")
-                db.session.add(draft_img)
-                images.append(draft_img)
-                image_n += 1
-            elif shape.has_text_frame:
-                text = getattr(shape, "text", "")
-                if not text: continue
-                l = save_labels(text, pres_n, slide_n, draft_id)
-                labels.extend(l)
-    
+    for slide_n, future in pending:
+        media = future.result()
+        if not media: continue
+        tmp_path, ext, digest = media
+
+        if digest in digests:
+            # Same content stored under another part name
+            os.remove(tmp_path)
+            continue
+        digests.add(digest)
+
+        filename = get_free_filename(draft.path, ext, "img", image_n)
+        os.replace(tmp_path, os.path.join(draft.path, filename))
+        print(f"Saved image {filename} from slide {slide_n + 1}")
+        images.append(DraftImage(draft_id, filename, pres_n, slide_n, label = ""))
+        image_n += 1
+
+    matched = assign_labels(draft_id, images, labels)
+    if matched: log_info(f"Labelled {matched} of {len(images)} images from their slide text")
+    db.session.add_all(images)
+    db.session.add_all(labels)
+
     # Increment the presentation counter for the next import
     draft.presentations += 1
     db.session.flush()
     db.session.commit()
     
-    return address, images, labels
+    return images, labels
+
+
+def part_rels(pres: zipfile.ZipFile, part: str) -> dict[str, str]:
+    """ Map relationship IDs of a package part to the names of the parts they point to. """
+    directory, name = posixpath.split(part)
+    rels_name = posixpath.join(directory, "_rels", f"{name}.rels")
+    if rels_name not in pres.NameToInfo: return {}
+
+    with pres.open(rels_name) as f:
+        root = ElementTree.parse(f).getroot()
+
+    rels: dict[str, str] = {}
+    for rel in root.iter(f"{{{NS_PACKAGE_RELS}}}Relationship"):
+        if rel.get("TargetMode") == "External": continue
+        target = rel.get("Target", "")
+        path = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(directory, target))
+        rels[rel.get("Id", "")] = path
+    return rels
+
+
+def slide_parts(pres: zipfile.ZipFile) -> list[str]:
+    """ Return part names of the slides in presentation order. """
+    rels = part_rels(pres, "ppt/presentation.xml")
+    with pres.open("ppt/presentation.xml") as f:
+        root = ElementTree.parse(f).getroot()
+
+    slide_ids = root.find(f"{{{NS_P}}}sldIdLst")
+    if slide_ids is None: return []
+    return [rels[rid] for slide in slide_ids if (rid := slide.get(f"{{{NS_R}}}id")) in rels]
+
+
+def slide_shapes(pres: zipfile.ZipFile, slide_part: str) -> Iterator[tuple[Literal["image", "text"], str]]:
+    """
+    Yield top-level pictures and text boxes of a slide in document order,
+    as `("image", media part name)` or `("text", shape text)`.
+    """
+    rels = part_rels(pres, slide_part)
+    with pres.open(slide_part) as f:
+        root = ElementTree.parse(f).getroot()
+
+    tree = root.find(f"{{{NS_P}}}cSld/{{{NS_P}}}spTree")
+    if tree is None: return
+
+    for shape in tree:
+        if shape.tag == f"{{{NS_P}}}pic":
+            blip = shape.find(f".//{{{NS_A}}}blip")
+            media = rels.get(blip.get(f"{{{NS_R}}}embed", "")) if blip is not None else None
+            if media: yield "image", media
+        elif shape.tag == f"{{{NS_P}}}sp":
+            body = shape.find(f"{{{NS_P}}}txBody")
+            if body is None: continue
+            text = "\n".join(paragraph_text(paragraph) for paragraph in body.iter(f"{{{NS_A}}}p"))
+            if text.strip(): yield "text", text
+
+
+def paragraph_text(paragraph: ElementTree.Element) -> str:
+    """ Text of a DrawingML paragraph, with line breaks as vertical tabs (same as python-pptx). """
+    parts: list[str] = []
+    for child in paragraph:
+        if child.tag in (f"{{{NS_A}}}r", f"{{{NS_A}}}fld"):
+            parts.append("".join(t.text or "" for t in child.iter(f"{{{NS_A}}}t")))
+        elif child.tag == f"{{{NS_A}}}br":
+            parts.append("\v")
+    return "".join(parts)
+
+
+def extract_media(address: str, part: str, target_directory: str) -> MediaFile | None:
+    """
+    Stream a media part of the presentation at `address` to a temporary file in the target directory.
+    Returns the temporary path, the file extension and the SHA-256 of the content, or None for unsupported media.
+    Opens its own handle on the archive, so it can run in parallel with other extractions.
+    """
+    ext = part.rsplit('.', 1)[-1].lower()
+    if ext == "jpeg": ext = "jpg"
+    if ext not in IMAGE_EXTENSIONS: return None
+
+    os.makedirs(target_directory, exist_ok = True)
+    fd, tmp_path = tempfile.mkstemp(suffix = ".part", prefix = ".import_", dir = target_directory)
+    digest = hashlib.sha256()
+    try:
+        with zipfile.ZipFile(address) as pres, pres.open(part) as src, os.fdopen(fd, 'wb') as dst:
+            while chunk := src.read(MEDIA_CHUNK_SIZE):
+                digest.update(chunk)
+                dst.write(chunk)
+        if os.path.getsize(tmp_path) > 0: return tmp_path, ext, digest.hexdigest()
+    except (KeyError, OSError, zipfile.BadZipFile):
+        pass
+
+    os.remove(tmp_path)
+    return None
+
+
+def discard_media(futures: Iterable[Future[MediaFile | None]]) -> None:
+    """ Remove the temporary files of finished extractions; cancelled ones never created theirs. """
+    for future in futures:
+        if future.cancelled() or future.exception() is not None: continue
+        media = future.result()
+        if media and os.path.exists(media[0]): os.remove(media[0])
 
 
 def temp_save(file: FileStorage) -> str | Literal[False]:
@@ -98,51 +244,40 @@ def temp_remove(file_path: str) -> bool:
     return True
 
 
-def save_image(image_bytes: bytes, ext: str, target_directory: str, start: int = 1) -> str | Literal[False]:
-    """ Save image bytes to a file in the target directory and return the filename. """
-    if not image_bytes: return False
-    if ext.lower() not in ['png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff']: return False
-
-    os.makedirs(target_directory, exist_ok = True)
-
-    filename = get_free_filename(target_directory, ext, "img", start)
-    path = os.path.join(target_directory, filename)
-
-    with open(path, 'wb') as f:
-        f.write(image_bytes)
-
-    return filename
-
-
 def get_free_filename(dir: str, ext: str, prefix: str = "tmp", start: int = 1) -> str:
-    """ Generate a free filename in the specified directory with the given extension and prefix. """
-    counter = start - 1
+    """
+    Reserve a free filename in the specified directory with the given extension and prefix.
+    The file is created empty with O_EXCL, so concurrent callers (threads or processes) never get the same name.
+    Counters are kept per directory and prefix, so allocation costs the same no matter how many files exist.
+    """
+    os.makedirs(dir, exist_ok = True)
+    key = (os.path.abspath(dir), prefix)
     while True:
-        counter += 1
+        with filename_lock:
+            if key not in filename_counters: filename_counters[key] = scan_free_index(dir, prefix)
+            counter = max(filename_counters[key], start)
+            filename_counters[key] = counter + 1
+
         filename = f"{prefix}_{counter:0>6}.{ext}"
-        path = os.path.join(dir, filename)
-        if not os.path.exists(path): return filename
+        try:
+            os.close(os.open(os.path.join(dir, filename), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return filename
+        except FileExistsError:
+            continue  # Taken by another process, try the next counter
 
 
-def get_free_index(dir: str, prefix: str = "tmp", ext: str = "*", start: int = 1) -> int:
-    """ Get the next free index for filenames in the specified directory with the given prefix and extension. """
-    counter = start
-    os.makedirs(dir, exist_ok = True)
-    while True:
-        # if not os.path.exists(path): return counter
-        for f in os.listdir(dir):
-            if f.startswith(f"{prefix}_{counter:0>6}.") and (ext == "*" or f.endswith(f".{ext}")): break
-        else: return counter
-        counter += 1
+def scan_free_index(dir: str, prefix: str) -> int:
+    """ Return the index after the highest one used by `prefix_NNNNNN.*` files. Only run once per directory. """
+    pattern = re.compile(rf"^{re.escape(prefix)}_(\d+)\.")
+    highest = 0
+    for entry in os.scandir(dir):
+        match = pattern.match(entry.name)
+        if match: highest = max(highest, int(match.group(1)))
+    return highest + 1
 
 
-def save_labels(text: str, pres_n: int, slide: int, draft_id: int) -> list[DraftLabel]:
-    """ Save text labels to the database and return a list of labels. """
+def parse_labels(text: str, pres_n: int, slide: int, draft_id: int) -> list[DraftLabel]:
+    """ Split text into labels, one per non-empty line. The labels are not added to the session. """
     if not text: return []
     labels = [line.strip() for line in text.splitlines() if line.strip()]
-    draft_labels: list[DraftLabel] = []
-    for label in labels:
-        draft_label = DraftLabel(draft_id, label, pres_n, slide)
-        draft_labels.append(draft_label)
-        db.session.add(draft_label)
-    return draft_labels
\ No newline at end of file
+    return [DraftLabel(draft_id, label, pres_n, slide) for label in labels]
\ No newline at end of file
@@ -0,0 +1,198 @@
+import uuid
+import click
+
+from sqlalchemy import delete, event, insert, inspect, select, update
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.app import app, db
+from app.models import Draft, DraftImage, DraftRemoval, Image, Set, SkipImage, User
+from app.lib.search_index import search_index
+from app.lib import label_index
+
+# Columns of a set image copied from its draft image
+COPIED = ("label", "notes", "draft_image_id")
+
+
+# Attributes whose change a publish has to carry to the set
+TRACKED = {DraftImage: ("filename", "label", "notes"), Draft: ("name", "description", "is_public", "thumbnail")}
+
+
+def is_tracked_change(obj) -> bool:
+    state = inspect(obj)
+    return any(state.attrs[key].history.has_changes() for key in TRACKED[type(obj)])
+
+
+@event.listens_for(db.session, "before_flush")
+def track_draft_changes(session, flush_context, instances) -> None:
+    """ Stamp edited draft images with the next `Draft.change_seq` and record deleted ones, in the same transaction """
+    stamped: dict[int, list[DraftImage]] = {}
+    removed: dict[int, list[str]] = {}
+    deleted_drafts = {obj.id for obj in session.deleted if isinstance(obj, Draft)}
+
+    for obj in session.new:
+        if isinstance(obj, DraftImage) and obj.draft_id is not None: stamped.setdefault(obj.draft_id, []).append(obj)
+    for obj in session.dirty:
+        if isinstance(obj, DraftImage) and is_tracked_change(obj):
+            stamped.setdefault(obj.draft_id, []).append(obj)
+            # A replaced image gets a new file; the set image under the old filename has to go like a deleted one
+            removed.setdefault(obj.draft_id, []).extend(filename for filename in inspect(obj).attrs.filename.history.deleted if filename)
+        elif isinstance(obj, Draft) and is_tracked_change(obj): stamped.setdefault(obj.id, [])
+    for obj in session.deleted:
+        if isinstance(obj, DraftImage): removed.setdefault(obj.draft_id, []).append(obj.filename)
+
+    conn = session.connection()
+    for draft_id in (stamped.keys() | removed.keys()) - deleted_drafts:
+        seq = conn.execute(
+            update(Draft.__table__).where(Draft.id == draft_id).values(change_seq = Draft.change_seq + 1).returning(Draft.change_seq)
+        ).scalar()
+        if seq is None: continue
+        for obj in stamped.get(draft_id, []): obj.seq = seq
+        session.add_all(DraftRemoval(draft_id, filename, seq) for filename in removed.get(draft_id, []))
+
+        draft = session.identity_map.get(identity_key(Draft, draft_id))
+        if draft is not None: set_committed_value(draft, "change_seq", seq)
+
+
+def draft_rows(draft_id: int, since: int = 0, until: int | None = None) -> tuple[dict[str, dict], set[str]]:
+    """
+    Labelled images of the draft by filename (first slide wins) and every filename looked at,
+    limited to images edited after change `since`
+    """
+    rows: dict[str, dict] = {}
+    seen: set[str] = set()
+    window = [DraftImage.seq > since, *([DraftImage.seq <= until] if until is not None else [])] if since else []
+    for row in db.session.execute(
+        select(DraftImage.id, DraftImage.filename, DraftImage.label, DraftImage.notes)
+        .where(DraftImage.draft_id == draft_id, *window)
+        .order_by(DraftImage.slide, DraftImage.id)
+    ).all():
+        seen.add(row.filename)
+        if row.label: rows.setdefault(row.filename, {"label": row.label, "notes": row.notes, "draft_image_id": row.id})
+    return rows, seen
+
+def removed_filenames(draft_id: int, since: int, until: int) -> set[str]:
+    return set(db.session.execute(
+        select(DraftRemoval.filename).where(DraftRemoval.draft_id == draft_id, DraftRemoval.seq > since, DraftRemoval.seq <= until)
+    ).scalars())
+
+def set_rows(set_id: int, filenames: set[str] | None = None) -> dict[str, dict]:
+    """ Images of the set by filename, all of them or only the given filenames """
+    rows: dict[str, dict] = {}
+    if filenames is not None and not filenames: return rows
+    for row in db.session.execute(
+        select(Image.id, Image.filename, Image.label, Image.notes, Image.draft_image_id)
+        .where(Image.set_id == set_id, *([Image.filename.in_(filenames)] if filenames is not None else []))
+    ).all():
+        # Older publishes could add a filename twice; the extra copies are removed as stale
+        rows.setdefault(row.filename, {"id": row.id, "label": row.label, "notes": row.notes, "draft_image_id": row.draft_image_id, "extra": []})["extra"].append(row.id)
+    for row in rows.values(): row["extra"].remove(row["id"])
+    return rows
+
+
+def diff(draft: dict[str, dict], current: dict[str, dict]) -> tuple[list[dict], list[dict], list[int]]:
+    """ Images to insert, images to update (by id) and ids to delete so the set matches the draft """
+    added = [{"filename": filename, **row} for filename, row in draft.items() if filename not in current]
+    changed = [
+        {"id": current[filename]["id"], **row} for filename, row in draft.items()
+        if filename in current and any(current[filename][key] != row[key] for key in COPIED)
+    ]
+    removed = [image_id for filename, row in current.items() for image_id in row["extra"] + ([] if filename in draft else [row["id"]])]
+    return added, changed, removed
+
+
+def apply(set_id: int, added: list[dict], changed: list[dict], removed: list[int]) -> None:
+    """ Bulk statements in the session's transaction; they skip the flush hooks, so the label index is updated here """
+    if removed:
+        db.session.execute(delete(SkipImage).where(SkipImage.image_id.in_(removed)))
+        db.session.execute(delete(Image).where(Image.id.in_(removed)))
+    if changed:
+        db.session.execute(update(Image), changed)
+
+    inserted: list[tuple[int, int, str | None]] = []
+    if added:
+        db.session.execute(insert(Image), [{"set_id": set_id, **row} for row in added])
+        # Read back rather than RETURNING, which SQLite can only keep in parameter order one row at a time
+        inserted = [(image_id, set_id, label) for image_id, label in db.session.execute(
+            select(Image.id, Image.label).where(Image.set_id == set_id, Image.filename.in_([row["filename"] for row in added]))
+        ).all()]
+
+    label_index.reindex_images(removed, inserted + [(row["id"], set_id, row["label"]) for row in changed])
+
+
+def publish(draft: Draft) -> tuple[Set, dict[str, int]]:
+    """
+    Create or update the draft's set, without committing. Reads the draft images edited since the last publish
+    (all of them for a new set) and the matching set images, then writes the difference with at most one
+    statement per kind of change. Returns the set and the number of images added, changed and removed.
+    """
+    db.session.flush()
+    db.session.refresh(draft, ["change_seq", "last_published_seq"])
+    since, until = draft.last_published_seq, draft.change_seq
+
+    set_ = db.session.get(Set, draft.set_id) if draft.set_id is not None else None
+    if set_ is None:
+        set_ = Set(name = draft.name or "Untitled Set", description = draft.description or "", is_public = draft.is_public)
+        set_.thumbnail = draft.thumbnail
+        db.session.add(set_)
+        db.session.flush()
+        draft.set_id = set_.id
+        images, _ = draft_rows(draft.id)
+        current: dict[str, dict] = {}
+    else:
+        set_.name = draft.name or set_.name
+        set_.description = draft.description or set_.description
+        set_.thumbnail = draft.thumbnail or set_.thumbnail
+        set_.is_public = draft.is_public
+        if since:
+            images, seen = draft_rows(draft.id, since, until)
+            current = set_rows(set_.id, seen | removed_filenames(draft.id, since, until))
+        else:
+            images, _ = draft_rows(draft.id)
+            current = set_rows(set_.id)
+
+    added, changed, removed = diff(images, current)
+    apply(set_.id, added, changed, removed)
+    db.session.expire(set_, ["images"])
+
+    draft.last_published_seq = until
+    db.session.execute(delete(DraftRemoval).where(DraftRemoval.draft_id == draft.id, DraftRemoval.seq <= until))
+
+    search_index.index_set(set_)
+    return set_, {"added": len(added), "changed": len(changed), "removed": len(removed)}
+
+
+@app.cli.command("check-publish")
+def check_publish() -> None:
+    """ Fail if an incremental republish leaves the set out of step with the draft; works in a transaction that is rolled back """
+    try:
+        user = User(f"check_{uuid.uuid4().hex[:8]}", None, "")
+        db.session.add(user)
+        db.session.flush()
+        draft = Draft()
+        draft.owner_id = user.id
+        draft.name = f"Publish check {uuid.uuid4().hex[:8]}"
+        db.session.add(draft)
+        db.session.flush()
+        images = [DraftImage(draft.id, f"check_{i}.png", 0, i, label = f"Label {i}") for i in range(3)]
+        db.session.add_all(images)
+        db.session.flush()
+        set_, _ = publish(draft)
+
+        # Edit one label, replace one image (as the replace routes do), delete one
+        images[0].label = "Label edited"
+        images[1].filename = "check_replaced.png"
+        db.session.delete(images[2])
+        _, changes = publish(draft)
+
+        published = {image.filename: image.label for image in db.session.execute(select(Image).where(Image.set_id == set_.id)).scalars()}
+        expected = {"check_0.png": "Label edited", "check_replaced.png": "Label 1"}
+        if published != expected:
+            click.echo(f"Republish left {published}, expected {expected} ({changes})", err = True)
+            raise SystemExit(1)
+        click.echo(f"Incremental republish is in step with the draft ({changes}).")
+    finally:
+        db.session.rollback()
+
+
+__all__ = ["diff", "publish"]
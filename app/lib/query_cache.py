@@ -0,0 +1,138 @@
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from typing import Any, Callable
+
+
+class QueryCache:
+    """
+    SQLite-backed cache for JSON-serializable API results.
+    Entries younger than `ttl` are served directly. Entries younger than `ttl + stale_ttl` are still served,
+    but trigger a single background refresh (stale-while-revalidate). Older entries are treated as misses,
+    and are deleted every `purge_every` stores.
+    """
+
+    def __init__(self, path: str, ttl: float, stale_ttl: float = 0, purge_every: int = 1000):
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.purge_every = purge_every
+
+        self._lock = threading.Lock()
+        self._stores = 0
+        self._refreshing: set[str] = set()
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS query_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout = 30)
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """ Build a cache key from JSON-serializable parts, e.g. `key(endpoint, params)`. """
+        return hashlib.sha256(json.dumps(parts, sort_keys = True, default = str).encode('utf-8')).hexdigest()
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+
+    def lookup(self, key: str, refresh: Callable[[], Any] | None = None) -> Any | None:
+        """
+        Return the cached value for `key`, or None on a miss.
+        When the value is stale and `refresh` is given, it is called in a background thread to replace it.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value, created FROM query_cache WHERE key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+
+        age = time.time() - row[1] if row else None
+        if row is None or age is None or age > self.ttl + self.stale_ttl:
+            self._count("misses")
+            return None
+
+        if age > self.ttl:
+            self._count("stale_hits")
+            if refresh is not None: self._revalidate(key, refresh)
+        else:
+            self._count("hits")
+
+        return json.loads(row[0])
+
+    def store(self, key: str, value: Any) -> None:
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO query_cache (key, value, created) VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._stores += 1
+            due = self._stores % self.purge_every == 0
+        if due: self.purge()
+
+    def get(self, key: str, loader: Callable[[], Any]) -> Any:
+        """ Return the cached value for `key`, calling `loader` and storing its result on a miss. """
+        value = self.lookup(key, loader)
+        if value is not None: return value
+
+        value = loader()
+        self.store(key, value)
+        return value
+
+    def _revalidate(self, key: str, loader: Callable[[], Any]) -> None:
+        with self._lock:
+            if key in self._refreshing: return
+            self._refreshing.add(key)
+
+        def run() -> None:
+            try:
+                self.store(key, loader())
+            except Exception:
+                pass  # Keep serving the stale value, the next lookup will try again
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target = run, daemon = True).start()
+
+    def purge(self) -> int:
+        """ Delete entries too old to be served, returns the number of removed rows. """
+        conn = self._connect()
+        try:
+            with conn:
+                return conn.execute("DELETE FROM query_cache WHERE created < ?", (time.time() - self.ttl - self.stale_ttl,)).rowcount
+        finally:
+            conn.close()
+
+    def stats(self) -> dict[str, int | float]:
+        conn = self._connect()
+        try:
+            entries = conn.execute("SELECT COUNT(*) FROM query_cache").fetchone()[0]
+        finally:
+            conn.close()
+
+        with self._lock:
+            stats: dict[str, int | float] = dict(self._stats)
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+        stats["entries"] = entries
+        stats["hit_ratio"] = (stats["hits"] + stats["stale_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+__all__ = ["QueryCache"]
@@ -0,0 +1,138 @@
+import os
+import re
+import click
+import tempfile
+
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from flask import g, has_request_context
+from sqlalchemy import Engine, Select, event, select, text
+
+from app.app import app, db
+from app.models import Draft, DraftAccess, DraftImage, DraftLabel, Image, Job, LabelTerm, Set, SkipImage, User, UserSettings
+from app.lib.db_bench import tuned_engine
+from app.lib import access
+
+# A plan step reading a whole table: "SCAN sets". Index scans read "SCAN sets USING INDEX ...".
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+# Shapes of the queries on hot paths, with placeholder values
+HOT_QUERIES: dict[str, Callable[[], Select]] = {
+    "public sets page":       lambda: select(Set.id).where(Set.is_public == True).order_by(Set.created_at.desc(), Set.id.desc()).limit(25),
+    "sets of owner":          lambda: select(Set.id).where(Set.owner_id == 1).order_by(Set.created_at.desc(), Set.id.desc()).limit(25),
+    "images of set":          lambda: select(Image).where(Image.set_id == 1),
+    "image of set by file":   lambda: select(Image).where(Image.set_id == 1, Image.filename == "img_1.png"),
+    "draft of set":           lambda: select(Draft).where(Draft.set_id == 1),
+    "drafts of owner":        lambda: select(Draft).where(Draft.owner_id == 1),
+    "images of draft":        lambda: select(DraftImage).where(DraftImage.draft_id == 1).order_by(DraftImage.slide),
+    "labels of draft":        lambda: select(DraftLabel).where(DraftLabel.draft_id == 1).order_by(DraftLabel.slide),
+    "play images":            lambda: select(Image.id).where(Image.set_id == 1, ~select(SkipImage.id).where(SkipImage.image_id == Image.id, SkipImage.user_id == 1).exists()),
+    "skips in set":           lambda: select(SkipImage).join(Image, SkipImage.image_id == Image.id).where(Image.set_id == 1, SkipImage.user_id == 1),
+    "skips of image":         lambda: select(SkipImage).where(SkipImage.image_id == 1),
+    "skip of user and image": lambda: select(SkipImage).where(SkipImage.user_id == 1, SkipImage.image_id == 1),
+    "access of draft":        lambda: select(DraftAccess).where(DraftAccess.draft_id == 1),
+    "access of user":         lambda: select(DraftAccess).where(DraftAccess.user_id == 1),
+    "settings of user":       lambda: select(UserSettings).where(UserSettings.user_id == 1),
+    "next queued job":        lambda: select(Job.id).where(Job.status == Job.QUEUED).order_by(Job.id).limit(1),
+    "draft edits since publish": lambda: select(DraftImage.id).where(DraftImage.draft_id == 1, DraftImage.seq > 5),
+    "label prefix":           lambda: select(LabelTerm.set_id).where(LabelTerm.term >= "parus", LabelTerm.term < "parus\U0010ffff"),
+}
+
+# Statements a warm play-mode render (/sets/<id>/cards) may run, independent of the set's size
+CARDS_QUERY_BUDGET = {"signed in": 4, "anonymous": 3}
+
+
+def query_plan(query: Select) -> list[str]:
+    sql = str(query.compile(dialect = db.engine.dialect, compile_kwargs = {"literal_binds": True}))
+    return [row[-1] for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()]
+
+def unindexed_queries() -> dict[str, list[str]]:
+    """ Hot queries whose plan reads a whole table, with the offending plan steps """
+    failures: dict[str, list[str]] = {}
+    for name, build in HOT_QUERIES.items():
+        scans = [step for step in query_plan(build()) if FULL_SCAN.match(step)]
+        if scans: failures[name] = scans
+    return failures
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany) -> None:
+    if has_request_context(): g.query_count = g.get("query_count", 0) + 1
+
+@app.after_request
+def query_count_header(response):
+    """ Report the statements a request ran as `X-Query-Count`, to keep per-page query budgets checkable """
+    if app.config["QUERY_COUNT_HEADER"]: response.headers["X-Query-Count"] = str(g.get("query_count", 0))
+    return response
+
+
+@app.cli.command("check-indexes")
+def check_indexes() -> None:
+    """ Fail if a hot query is planned as a full table scan """
+    failures = unindexed_queries()
+    for name, scans in failures.items():
+        click.echo(f"{name}: {', '.join(scans)}", err = True)
+    if failures: raise SystemExit(1)
+    click.echo(f"All {len(HOT_QUERIES)} hot queries use an index.")
+
+
+def cards_query_counts(set_hash: str, user_id: int) -> dict[str, int]:
+    """ Statements run by a second (warm) render of the set's cards page, per kind of visitor """
+    counts: dict[str, int] = {}
+    header = app.config["QUERY_COUNT_HEADER"]
+    app.config["QUERY_COUNT_HEADER"] = True
+    try:
+        for visitor in CARDS_QUERY_BUDGET:
+            client = app.test_client()
+            if visitor == "signed in":
+                with client.session_transaction() as session:
+                    session["_user_id"] = str(user_id)
+                    session["_fresh"] = True
+            for _ in range(2):
+                response = client.get(f"/sets/{set_hash}/cards")
+            if response.status_code != 200: raise click.ClickException(f"Cards page returned {response.status_code} for {visitor} visitor")
+            counts[visitor] = int(response.headers["X-Query-Count"])
+    finally:
+        app.config["QUERY_COUNT_HEADER"] = header
+    return counts
+
+
+@app.cli.command("check-query-budget")
+def check_query_budget() -> None:
+    """
+    Fail if the play-mode page runs more statements than its budget. The app is pointed at a temporary SQLite
+    database while the check runs, so nothing is written to the configured one. The pages are requested from
+    another thread, outside the command's app context, so they get their own session and `g`.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        engine = tuned_engine(os.path.join(directory, "budget.sqlite"))
+        db.metadata.create_all(engine)
+        configured = db.engines[None]
+        db.session.remove()
+        db.engines[None] = engine  # Sessions look the engine up here on every checkout, including the requests' ones
+        try:
+            user = User("budget", None, "")
+            db.session.add(user)
+            db.session.flush()
+            set_ = Set(name = "Query budget check", description = "", is_public = True)
+            set_.owner_id = user.id
+            db.session.add(set_)
+            db.session.flush()
+            db.session.add_all(Image(f"check_{i}.png", f"Label {i}", set_id = set_.id) for i in range(10))
+            db.session.commit()
+
+            with ThreadPoolExecutor(max_workers = 1) as executor:
+                counts = executor.submit(cards_query_counts, set_.hid(), user.id).result()
+        finally:
+            db.session.remove()
+            db.engines[None] = configured
+            engine.dispose()
+            access.cache.clear()  # Decisions about the temporary rows
+
+    over = {visitor: count for visitor, count in counts.items() if count > CARDS_QUERY_BUDGET[visitor]}
+    for visitor, count in counts.items():
+        click.echo(f"{visitor}: {count} statements (budget {CARDS_QUERY_BUDGET[visitor]})", err = visitor in over)
+    if over: raise SystemExit(1)
+
+
+__all__ = ["CARDS_QUERY_BUDGET", "HOT_QUERIES", "query_plan", "unindexed_queries"]
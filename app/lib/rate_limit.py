@@ -0,0 +1,82 @@
+
+import time
+import asyncio
+import sqlite3
+import threading
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` acquisitions per second with bursts of up to `capacity`.
+    Callers reserve a token up front and sleep until their slot, so waiting threads are served in order.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """ Take a token and return how many seconds the caller must wait before using it. """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate) - 1
+            self._updated = now
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0: time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        wait = self.reserve()
+        if wait > 0: await asyncio.sleep(wait)
+
+
+class SqliteTokenBucket(TokenBucket):
+    """ Token bucket whose state lives in an SQLite file, so the quota is shared by every process using it. """
+
+    def __init__(self, path: str, name: str, rate: float, capacity: float = 1):
+        super().__init__(rate, capacity)
+        self.path = path
+        self.name = name
+
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS token_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+
+    def reserve(self) -> float:
+        conn = self._connect()
+        try:
+            # Take the write lock before reading, so concurrent processes can't reserve the same token
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM token_buckets WHERE name = ?", (self.name,)).fetchone()
+            tokens, updated = row if row else (self.capacity, now)
+
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate) - 1
+            conn.execute("INSERT OR REPLACE INTO token_buckets (name, tokens, updated) VALUES (?, ?, ?)", (self.name, tokens, now))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        return max(0.0, -tokens / self.rate)
+
+    async def acquire_async(self) -> None:
+        # The database lock may be contended, so don't block the event loop on it
+        wait = await asyncio.to_thread(self.reserve)
+        if wait > 0: await asyncio.sleep(wait)
+
+
+def create_token_bucket(rate: float, capacity: float = 1, path: str | None = None, name: str = "default") -> TokenBucket:
+    """ Create a process-wide bucket, or a cross-process one backed by the SQLite file at `path`. """
+    if path: return SqliteTokenBucket(path, name, rate, capacity)
+    return TokenBucket(rate, capacity)
+
+
+__all__ = ["TokenBucket", "SqliteTokenBucket", "create_token_bucket"]
@@ -0,0 +1,57 @@
+import time
+import pickle
+import threading
+
+from typing import Any, Callable, Generic, TypeVar
+from flask import g, has_app_context
+from sqlalchemy import event
+
+from app.app import db
+
+T = TypeVar("T")
+
+
+def memo(key: Any, loader: Callable[[], T]) -> T:
+    """ Return `loader()`, computed at most once per request (app context) for the given key """
+    if not has_app_context(): return loader()
+    values: dict = g.setdefault("memo", {})
+    if key not in values: values[key] = loader()
+    return values[key]
+
+
+class EntityCache(Generic[T]):
+    """
+    Short-lived cross-request cache of rows of one model, kept as detached snapshots.
+    A hit is merged into the current session without a query. Flushes in this process drop the rows they change;
+    other processes see the change once `ttl` has passed.
+    """
+
+    def __init__(self, model: type[T], ttl: Callable[[], float]):
+        self.model = model
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: dict[int, tuple[bytes, float]] = {}
+        event.listen(db.session, "after_flush", self._invalidate_flushed)
+
+    def get(self, row_id: int) -> T | None:
+        with self._lock:
+            entry = self._entries.get(row_id)
+        if entry is not None and entry[1] >= time.monotonic():
+            return db.session.merge(pickle.loads(entry[0]), load = False)
+
+        obj = db.session.get(self.model, row_id)
+        if obj is not None:
+            with self._lock:
+                self._entries[row_id] = (pickle.dumps(obj), time.monotonic() + self.ttl())
+        return obj
+
+    def invalidate(self, row_id: int) -> None:
+        with self._lock:
+            self._entries.pop(row_id, None)
+
+    def _invalidate_flushed(self, session, flush_context) -> None:
+        for obj in session.dirty | session.deleted:
+            if isinstance(obj, self.model): self.invalidate(getattr(obj, "id"))
+
+
+__all__ = ["memo", "EntityCache"]
@@ -0,0 +1,219 @@
+import re
+import bisect
+import threading
+import unicodedata
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app.app import db, log_info
+from app.models import Image, Set, User
+
+# Sets and users share one index; the document rowid is the row id shifted left by one,
+# with the low bit telling the two apart so deletes and lookups stay rowid-based.
+KIND_SET  = 0
+KIND_USER = 1
+
+# Column weights for ranking: name, description, labels
+WEIGHTS = (10.0, 2.0, 1.0)
+# Candidates fetched per requested set, so sets hidden from the user do not empty the page
+OVERSAMPLE = 4
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize(value: str) -> str:
+    """ Lowercase and strip diacritics, so 'Čáp' matches 'cap' """
+    decomposed = unicodedata.normalize("NFKD", value.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def tokenize(value: str) -> list[str]:
+    return TOKEN_RE.findall(normalize(value))
+
+def doc_id(kind: int, row_id: int) -> int:
+    return row_id * 2 + kind
+
+
+class FtsBackend:
+    """ SQLite FTS5 table in the application database; writes join the caller's transaction """
+
+    def create(self) -> bool:
+        """ Create the table, returns True when it did not exist yet """
+        exists = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'search_fts'")).first() is not None
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5("
+            "name, description, labels, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        ))
+        db.session.commit()
+        return not exists
+
+    def put(self, rowid: int, name: str, description: str = "", labels: str = "") -> None:
+        db.session.execute(text("DELETE FROM search_fts WHERE rowid = :rowid"), {"rowid": rowid})
+        db.session.execute(text("INSERT INTO search_fts (rowid, name, description, labels) VALUES (:rowid, :name, :description, :labels)"),
+                           {"rowid": rowid, "name": name, "description": description, "labels": labels})
+
+    def remove(self, rowid: int) -> None:
+        db.session.execute(text("DELETE FROM search_fts WHERE rowid = :rowid"), {"rowid": rowid})
+
+    def clear(self, kind: int | None = None) -> None:
+        if kind is None: db.session.execute(text("DELETE FROM search_fts"))
+        else: db.session.execute(text("DELETE FROM search_fts WHERE rowid % 2 = :kind"), {"kind": kind})
+
+    def search(self, terms: list[str], kind: int, limit: int) -> list[int]:
+        # Every term is quoted (no FTS syntax from user input) and matched as a prefix
+        match = " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+        rows = db.session.execute(text(
+            "SELECT rowid FROM search_fts WHERE search_fts MATCH :match AND rowid % 2 = :kind "
+            f"ORDER BY bm25(search_fts, {', '.join(map(str, WEIGHTS))}) LIMIT :limit"
+        ), {"match": match, "kind": kind, "limit": limit}).all()
+        return [row[0] // 2 for row in rows]
+
+
+class MemoryBackend:
+    """
+    Pure-Python inverted index, used when SQLite was built without FTS5.
+    It lives in process memory, is rebuilt from the database on startup and is only kept in sync
+    with writes made by this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs: dict[int, dict[str, float]] = {}       # rowid -> token -> weight
+        self._postings: dict[str, dict[int, float]] = {}   # token -> rowid -> weight
+        self._tokens: list[str] = []                       # sorted, for prefix lookups
+
+    def create(self) -> bool:
+        return True  # Always empty on startup
+
+    def put(self, rowid: int, name: str, description: str = "", labels: str = "") -> None:
+        weights: dict[str, float] = {}
+        for weight, field in zip(WEIGHTS, (name, description, labels)):
+            for token in tokenize(field):
+                weights[token] = weights.get(token, 0) + weight
+
+        with self._lock:
+            self._remove(rowid)
+            self._docs[rowid] = weights
+            for token, weight in weights.items():
+                if token not in self._postings:
+                    self._postings[token] = {}
+                    bisect.insort(self._tokens, token)
+                self._postings[token][rowid] = weight
+
+    def remove(self, rowid: int) -> None:
+        with self._lock:
+            self._remove(rowid)
+
+    def _remove(self, rowid: int) -> None:
+        for token in self._docs.pop(rowid, {}):
+            self._postings.get(token, {}).pop(rowid, None)
+
+    def clear(self, kind: int | None = None) -> None:
+        with self._lock:
+            for rowid in [rowid for rowid in self._docs if kind is None or rowid % 2 == kind]:
+                self._remove(rowid)
+
+    def search(self, terms: list[str], kind: int, limit: int) -> list[int]:
+        scores: dict[int, float] | None = None
+        with self._lock:
+            for term in terms:
+                matches: dict[int, float] = {}
+                start = bisect.bisect_left(self._tokens, term)
+                for token in self._tokens[start:]:
+                    if not token.startswith(term): break
+                    for rowid, weight in self._postings[token].items():
+                        if rowid % 2 == kind: matches[rowid] = matches.get(rowid, 0) + weight
+
+                # All terms must match, as in FTS5
+                scores = matches if scores is None else {rowid: score + matches[rowid] for rowid, score in scores.items() if rowid in matches}
+                if not scores: return []
+
+        ranked = sorted((scores or {}).items(), key = lambda item: (-item[1], item[0]))
+        return [rowid // 2 for rowid, _ in ranked[:limit]]
+
+
+class SearchIndex:
+    """ Ranked prefix search over set names, descriptions, image labels and usernames """
+
+    def __init__(self):
+        self.backend: FtsBackend | MemoryBackend | None = None
+
+    def init(self) -> None:
+        """ Pick the backend and fill the index if it is new. Call inside an app context. """
+        backend = None
+        if db.engine.dialect.name == "sqlite":
+            try:
+                backend = FtsBackend()
+                created = backend.create()
+            except OperationalError:
+                db.session.rollback()
+                backend = None
+        if backend is None:
+            log_info("No FTS5 support in the database, using the in-memory search index")
+            backend = MemoryBackend()
+            created = backend.create()
+
+        self.backend = backend
+        if created: self.rebuild()
+
+    def rebuild(self) -> None:
+        if self.backend is None: return
+        self.backend.clear()
+
+        labels: dict[int, list[str]] = {}
+        for set_id, label in db.session.execute(db.select(Image.set_id, Image.label).where(Image.label != None)).all():
+            labels.setdefault(set_id, []).append(label)
+        for set_ in db.session.execute(db.select(Set)).scalars():
+            self.backend.put(doc_id(KIND_SET, set_.id), set_.name, set_.description, " ".join(labels.get(set_.id, [])))
+        for user in db.session.execute(db.select(User)).scalars():
+            self.backend.put(doc_id(KIND_USER, user.id), user.username)
+        db.session.commit()
+
+    def index_set(self, set_: Set) -> None:
+        """ Add or refresh a set; call before committing the change that published or renamed it """
+        if self.backend is None: return
+        # Queried rather than read from set_.images, so pending adds and deletes are flushed and seen
+        labels = " ".join(db.session.execute(db.select(Image.label).where(Image.set_id == set_.id, Image.label != None)).scalars())
+        self.backend.put(doc_id(KIND_SET, set_.id), set_.name, set_.description, labels)
+
+    def remove_set(self, set_id: int | None) -> None:
+        if self.backend is None or set_id is None: return
+        self.backend.remove(doc_id(KIND_SET, set_id))
+
+    def clear_sets(self) -> None:
+        if self.backend is None: return
+        self.backend.clear(KIND_SET)
+
+    def index_user(self, user: User) -> None:
+        if self.backend is None: return
+        self.backend.put(doc_id(KIND_USER, user.id), user.username)
+
+    def search_sets(self, query: str, limit: int = 50) -> list[int]:
+        """ Ids of sets matching every word of the query as a prefix, best match first """
+        terms = tokenize(query)
+        if self.backend is None or not terms: return []
+        return self.backend.search(terms, KIND_SET, limit)
+
+    def search_users(self, query: str, limit: int = 10) -> list[int]:
+        terms = tokenize(query)
+        if self.backend is None or not terms: return []
+        return self.backend.search(terms, KIND_USER, limit)
+
+    def find_sets(self, query: str, user, limit: int = 50) -> list[Set]:
+        """ Matching sets the user may see, in rank order, with listing details loaded """
+        ids = self.search_sets(query, limit * OVERSAMPLE)
+        if not ids: return []
+        found = {set_.id: set_ for set_ in Set.with_details(Set.visible_to(user).where(Set.id.in_(ids))).all()}
+        return [found[set_id] for set_id in ids if set_id in found][:limit]
+
+    def find_users(self, query: str, limit: int = 10) -> list[User]:
+        ids = self.search_users(query, limit)
+        if not ids: return []
+        found = {user.id: user for user in User.query.where(User.id.in_(ids)).all()}
+        return [found[user_id] for user_id in ids if user_id in found]
+
+
+search_index = SearchIndex()
+
+
+__all__ = ["SearchIndex", "search_index", "normalize", "tokenize"]
@@ -2,24 +2,10 @@
 from pathlib import Path
 from urllib.parse import unquote
 
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from app.lib.http_client import session
 
 
 WIKI_API = "https://cs.wikipedia.org/w/api.php"
-HEADERS = {"User-Agent": "Recognify"}
-
-
-session = requests.Session()
-
-retry = Retry(total = 5, backoff_factor = 2, status_forcelist = [429, 500, 502, 503, 504], allowed_methods = ["GET"])
-adapter = HTTPAdapter(max_retries = retry)
-
-session.mount("https://", adapter)
-session.mount("http://", adapter)
-
-session.headers.update(HEADERS)
 
 
 def search(query: str) -> str | None:
@@ -4,8 +4,14 @@ import logging
 import sys
 
 from app import routes # Assign blueprints
-from app.app import app, db, get_data, login
+
+from sqlalchemy import event
+
+from app.app import app, apply_sqlite_pragmas, db, get_data, login, migrate
 from app.models import Draft, Set, User, UserSettings
+from app.lib.search_index import search_index
+from app.lib.request_cache import EntityCache
+from app.lib import access, db_bench, label_index, query_plans  # access registers its cache invalidation, query_plans `flask check-indexes`, db_bench `flask bench-db`
 
 # Redirect Werkzeug reloader messages to stdout only
 werkzeug_logger = logging.getLogger('werkzeug')
@@ -16,9 +22,14 @@ console_handler.setFormatter(logging.Formatter('%(message)s'))
 werkzeug_logger.addHandler(console_handler)
 werkzeug_logger.propagate = False
 
+user_cache = EntityCache(User, lambda: app.config["USER_CACHE_TTL"])
+
 @login.user_loader
 def load_user(user_id: int) -> User | None:
-    return User.query.filter_by(id = user_id).first()
+    try:
+        return user_cache.get(int(user_id))
+    except ValueError:
+        return None
 
 @app.context_processor
 def inject_user():
@@ -26,6 +37,12 @@ def inject_user():
 
 db.init_app(app)
 login.init_app(app)
+migrate.init_app(app, db)
 
 with app.app_context():
+    if db.engine.dialect.name == "sqlite": event.listen(db.engine, "connect", apply_sqlite_pragmas)
     db.create_all()
+    # create_all skips tables that already exist; indexes and constraints added later come from migrations/,
+    # applied once per deploy with `flask --app app.main db upgrade` rather than by every process that imports the app
+    search_index.init()
+    label_index.init()
@@ -1,14 +1,17 @@
 from flask import url_for
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.orm import Mapped, column_property, joinedload, mapped_column, relationship, selectinload, undefer
 from flask_login import UserMixin, current_user
-from sqlalchemy import Integer, String, Boolean, ForeignKey, DateTime, Text, Float
+from sqlalchemy import Integer, String, Boolean, ForeignKey, DateTime, Text, Float, Index, delete, func, literal, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 import os.path
 import datetime
 import werkzeug.security
 import hashlib
 
-from app.app import UPLOAD_PATH, db, encode, encode_image, DEFAULT_THUMBNAIL_URL
+from app.app import UPLOAD_PATH, db, encode, encode_cursor, encode_image, DEFAULT_THUMBNAIL_URL
+from app.lib.request_cache import memo
 
 
 class User(db.Model, UserMixin):
@@ -45,15 +48,8 @@ class User(db.Model, UserMixin):
         }
 
     def has_access_to(self, to: "Draft | Set | None") -> bool:
-        if to is None or not isinstance(to, (Draft, Set)): return False
-        if to.owner_id == self.id: return True
-        draft = to
-        if isinstance(to, Set):
-            if to.is_public: return True
-            draft = to.draft
-        if draft is None or not isinstance(draft, Draft): return False
-
-        return self.id in draft.get_access_users()
+        from app.lib.access import can_access
+        return can_access(self, to)
 
     def get_drafts(self) -> list["Draft"]:
         return list(db.session.execute(Draft.query.outerjoin(DraftAccess, Draft.id == DraftAccess.draft_id)\
@@ -65,17 +61,16 @@ class User(db.Model, UserMixin):
         return f"https://www.gravatar.com/avatar/{hash_email}?d=identicon&s={size}"
 
     def settings(self) -> "UserSettings":
-        res = db.session.execute(UserSettings.query.where(UserSettings.user_id == self.id)).scalar_one_or_none()
-        if not isinstance(res, UserSettings):
-            res = UserSettings()
-            res.user_id = self.id
-            db.session.add(res)
-            db.session.commit()
-        return res
+        return UserSettings.settings(self)
 
 
 class Set(db.Model):
     __tablename__ = "sets"
+    __table_args__ = (
+        # Keyset pagination (see `Set.page`) walks these newest first
+        Index("ix_sets_public_created", "is_public", "created_at", "id"),
+        Index("ix_sets_owner_created",  "owner_id",  "created_at", "id"),
+    )
 
     id:          Mapped[int]  = mapped_column(Integer, primary_key = True, autoincrement = True)
     name:        Mapped[str]  = mapped_column(String(64), unique = True, nullable = False)
@@ -88,23 +83,33 @@ class Set(db.Model):
 
     owner: Mapped["User"] = relationship("User", back_populates = "sets", lazy = "select")
     images: Mapped[list["Image"]] = relationship("Image", back_populates = "set", lazy = "select")
+    draft: Mapped["Draft | None"] = relationship("Draft", uselist = False, viewonly = True, lazy = "select")
 
     @staticmethod
-    def all() -> list["Set"]: return Set.query.where(Set.is_public == True).all()
+    def with_details(query):
+        """ Eager-load what set listings render: the draft (for the thumbnail), the owner and the image count """
+        return query.options(selectinload(Set.draft), joinedload(Set.owner), undefer(Set.image_count))
 
     @staticmethod
-    def all_for(user) -> list["Set"]:
-        """ Return all public sets and all sets this user has access to """
-        if user is None or user.is_anonymous: return Set.all()
-        
-        return Set.query.join(Draft, Set.id == Draft.set_id)\
-            .outerjoin(DraftAccess, Draft.id == DraftAccess.draft_id)\
-            .where(
-                (Set.is_public == True) | 
-                (Set.owner_id == user.id) | 
-                ((Draft.owner_id == user.id)) |
-                ((DraftAccess.user_id == user.id))
-            ).distinct().all()
+    def visible_to(user):
+        """ Query for all public sets and all sets this user has access to """
+        if user is None or user.is_anonymous: return Set.query.where(Set.is_public == True)
+
+        shared = select(Draft.id).outerjoin(DraftAccess, Draft.id == DraftAccess.draft_id)\
+            .where(Draft.set_id == Set.id, (Draft.owner_id == user.id) | (DraftAccess.user_id == user.id)).exists()
+        return Set.query.where((Set.is_public == True) | (Set.owner_id == user.id) | shared)
+
+    @staticmethod
+    def page(query, after: tuple[datetime.datetime, int] | None = None, limit: int = 20) -> tuple[list["Set"], str | None]:
+        """ Return up to `limit` sets of the query, newest first, after the given (created_at, id) position,
+            and the cursor of the next page (None on the last page) """
+        if after is not None: query = query.where(tuple_(Set.created_at, Set.id) < tuple_(*after))
+
+        sets = Set.with_details(query.order_by(Set.created_at.desc(), Set.id.desc()).limit(limit + 1)).all()
+        if len(sets) <= limit: return sets, None
+
+        sets = sets[:limit]
+        return sets, encode_cursor(sets[-1].created_at, sets[-1].id)
 
     def __init__(self, name: str, description: str = "", is_public: bool = False):
         self.name = name
@@ -125,23 +130,22 @@ class Set(db.Model):
             "is_public": self.is_public
         }
 
-    @property
-    def draft(self) -> "Draft | None":
-        return db.session.execute(Draft.query.where(Draft.set_id == self.id)).scalar_one_or_none()
-
     def skip_images(self, user_id: int) -> list[str]:
         """ Returns list of image hash ids skipped by the user in this set """
-        res = db.session.execute(SkipImage.query.join(Image).where(Image.set_id == self.id, SkipImage.user_id == user_id)).scalars().all()
-        return [skip.hid() for skip in res if isinstance(skip, SkipImage)]
+        image_ids = db.session.execute(select(SkipImage.image_id).join(Image, SkipImage.image_id == Image.id)\
+            .where(Image.set_id == self.id, SkipImage.user_id == user_id)).scalars()
+        return [encode_image(self.id, image_id) for image_id in image_ids]
 
-    def images_for(self, user: User | None) -> list["Image"]:
-        """ Returns list of images in this set, excluding those skipped by the user """
-        if user is None or user.is_anonymous: return self.images
+    def play_images(self, user: User | None) -> list[dict]:
+        """ Hash id, label and notes of the images in this set, excluding those skipped by the user """
+        query = select(Image.id, Image.label, Image.notes).where(Image.set_id == self.id)
+        if user is not None and not user.is_anonymous:
+            # Anti-join scoped to this set, so the cost does not grow with the user's skips elsewhere
+            skipped = select(SkipImage.id).where(SkipImage.image_id == Image.id, SkipImage.user_id == user.id).exists()
+            query = query.where(~skipped)
 
-        skipped_image_ids = {skip.image_id for skip in db.session.execute(
-            SkipImage.query.where(SkipImage.user_id == user.id)
-        ).scalars().all()}
-        return [img for img in self.images if img.id not in skipped_image_ids]
+        return [{"id": encode_image(self.id, image_id), "label": label, "notes": notes}
+                for image_id, label, notes in db.session.execute(query).all()]
 
     @property
     def thumbnail_url(self) -> str:
@@ -152,6 +156,10 @@ class Set(db.Model):
 
 class Image(db.Model):
     __tablename__ = "images"
+    __table_args__ = (
+        # Set contents, and publish looking up an image of the set by filename
+        Index("ix_images_set_filename", "set_id", "filename"),
+    )
 
     id:             Mapped[int]      = mapped_column(Integer, primary_key = True, autoincrement = True)
     filename:       Mapped[str]      = mapped_column(String(128), nullable = False)
@@ -183,8 +191,19 @@ class Image(db.Model):
         }
 
 
+# Declared once Image exists; deferred, so it is only loaded by queries that ask for it (see `Set.with_details`)
+Set.image_count = column_property(
+    select(func.count(Image.id)).where(Image.set_id == Set.id).correlate_except(Image).scalar_subquery(),
+    deferred = True,
+)
+
+
 class Draft(db.Model):
     __tablename__ = "drafts"
+    __table_args__ = (
+        Index("ix_drafts_set",   "set_id"),
+        Index("ix_drafts_owner", "owner_id"),
+    )
 
     id:            Mapped[int]  = mapped_column(Integer, primary_key = True, autoincrement = True)
     name:          Mapped[str]  = mapped_column(String(64), nullable = False, default = "")
@@ -195,6 +214,9 @@ class Draft(db.Model):
     is_public:     Mapped[bool] = mapped_column(Boolean, default = False, nullable = False)
     set_id:        Mapped[int|None]  = mapped_column(ForeignKey("sets.id"), nullable = True, default = None)
     thumbnail:     Mapped[str|None] = mapped_column(String(128), nullable = True, default = None)
+    # Bumped by every tracked edit (see `app.lib.publish`); a publish only reads rows stamped after `last_published_seq`
+    change_seq:         Mapped[int] = mapped_column(Integer, default = 0, nullable = False)
+    last_published_seq: Mapped[int] = mapped_column(Integer, default = 0, nullable = False)
 
     images: Mapped[list["DraftImage"]] = relationship("DraftImage", back_populates = "draft", lazy = "select", cascade = "all, delete-orphan")
     labels: Mapped[list["DraftLabel"]] = relationship("DraftLabel", back_populates = "draft", lazy = "select", cascade = "all, delete-orphan")
@@ -208,6 +230,9 @@ class Draft(db.Model):
     def is_published(self) -> bool:
         return isinstance(self.set_id, int) and self.set_id > 0
 
+    def has_unpublished_changes(self) -> bool:
+        return not self.is_published() or self.change_seq > self.last_published_seq
+
     def hid(self) -> str:
         return encode(self.id)
     
@@ -237,6 +262,10 @@ class Draft(db.Model):
 
 class DraftImage(db.Model):
     __tablename__ = "draft_images"
+    __table_args__ = (
+        Index("ix_draft_images_draft", "draft_id", "slide"),
+        Index("ix_draft_images_seq",   "draft_id", "seq"),
+    )
 
     id:       Mapped[int] = mapped_column(Integer, primary_key = True, autoincrement = True)
     draft_id: Mapped[int] = mapped_column(ForeignKey("drafts.id"), nullable = False)
@@ -244,6 +273,7 @@ class DraftImage(db.Model):
     slide:    Mapped[int] = mapped_column(Integer,     nullable = False)
     label:    Mapped[str] = mapped_column(String(128), nullable = True)
     notes:    Mapped[str] = mapped_column(String(256), nullable = True)
+    seq:      Mapped[int] = mapped_column(Integer, default = 0, nullable = False)  # `Draft.change_seq` of the last edit
 
     draft: Mapped["Draft"] = relationship("Draft", back_populates = "images")
 
@@ -264,12 +294,51 @@ class DraftImage(db.Model):
             "label": self.label,
             "notes": self.notes,
             "slide": self.slide,
+            "seq": self.seq,
             "draft_id": encode(self.draft_id)
         }
 
 
+class DraftRemoval(db.Model):
+    """ Filename of a draft image deleted after the last publish, so the next publish removes it from the set """
+    __tablename__ = "draft_removals"
+    __table_args__ = (
+        Index("ix_draft_removals_seq", "draft_id", "seq"),
+    )
+
+    id:       Mapped[int] = mapped_column(Integer, primary_key = True, autoincrement = True)
+    draft_id: Mapped[int] = mapped_column(ForeignKey("drafts.id"), nullable = False)
+    filename: Mapped[str] = mapped_column(String(128), nullable = False)
+    seq:      Mapped[int] = mapped_column(Integer, nullable = False)
+
+    def __init__(self, draft_id: int, filename: str, seq: int):
+        self.draft_id = draft_id
+        self.filename = filename
+        self.seq = seq
+
+
+class LabelTerm(db.Model):
+    """ Normalized search term of an image or draft image label, maintained by `app.lib.label_index` """
+    __tablename__ = "label_terms"
+    __table_args__ = (
+        Index("ix_label_terms_term", "term"),
+        Index("ix_label_terms_image", "image_id"),
+        Index("ix_label_terms_draft_image", "draft_image_id"),
+    )
+
+    id:             Mapped[int]      = mapped_column(Integer, primary_key = True, autoincrement = True)
+    term:           Mapped[str]      = mapped_column(String(128), nullable = False)
+    image_id:       Mapped[int|None] = mapped_column(ForeignKey("images.id"), nullable = True, default = None)
+    set_id:         Mapped[int|None] = mapped_column(ForeignKey("sets.id"), nullable = True, default = None)
+    draft_image_id: Mapped[int|None] = mapped_column(ForeignKey("draft_images.id"), nullable = True, default = None)
+    draft_id:       Mapped[int|None] = mapped_column(ForeignKey("drafts.id"), nullable = True, default = None)
+
+
 class DraftLabel(db.Model):
     __tablename__ = "draft_labels"
+    __table_args__ = (
+        Index("ix_draft_labels_draft", "draft_id", "slide"),
+    )
 
     id:       Mapped[int] = mapped_column(Integer, primary_key = True, autoincrement = True)
     draft_id: Mapped[int] = mapped_column(ForeignKey("drafts.id"), nullable = False)
@@ -297,6 +366,11 @@ class DraftLabel(db.Model):
 
 class SkipImage(db.Model):
     __tablename__ = "skip_images"
+    __table_args__ = (
+        # One skip per user and image; also serves "skips of this user"
+        Index("uq_skip_images_user_image", "user_id", "image_id", unique = True),
+        Index("ix_skip_images_image", "image_id"),
+    )
 
     id:       Mapped[int] = mapped_column(Integer, primary_key = True, autoincrement = True)
     user_id:  Mapped[int] = mapped_column(ForeignKey("users.id"), nullable = False)
@@ -309,6 +383,22 @@ class SkipImage(db.Model):
         self.user_id = user_id
         self.image_id = image_id
 
+    @staticmethod
+    def add_many(user_id: int, set_id: int, image_ids: list[int]) -> int:
+        """ Skip the given images of the set in one statement; images already skipped or not in the set are ignored """
+        insert = postgresql_insert if db.session.get_bind().dialect.name == "postgresql" else sqlite_insert
+        statement = insert(SkipImage).from_select(
+            ["user_id", "image_id"],
+            select(literal(user_id), Image.id).where(Image.set_id == set_id, Image.id.in_(image_ids)),
+        ).on_conflict_do_nothing(index_elements = ["user_id", "image_id"])
+        return db.session.execute(statement).rowcount
+
+    @staticmethod
+    def remove_many(user_id: int, set_id: int, image_ids: list[int]) -> int:
+        """ Unskip the given images of the set in one statement """
+        in_set = select(Image.id).where(Image.set_id == set_id, Image.id.in_(image_ids))
+        return db.session.execute(delete(SkipImage).where(SkipImage.user_id == user_id, SkipImage.image_id.in_(in_set))).rowcount
+
     def hid(self) -> str:
         img = Image.query.where(Image.id == self.image_id).first()
         if not isinstance(img, Image): return ""
@@ -323,6 +413,10 @@ class SkipImage(db.Model):
 
 class DraftAccess(db.Model):
     __tablename__ = "draft_access"
+    __table_args__ = (
+        Index("uq_draft_access_draft_user", "draft_id", "user_id", unique = True),
+        Index("ix_draft_access_user", "user_id", "draft_id"),
+    )
 
     id:       Mapped[int] = mapped_column(Integer, primary_key = True, autoincrement = True)
     draft_id: Mapped[int] = mapped_column(ForeignKey("drafts.id"), nullable = False)
@@ -338,6 +432,9 @@ class DraftAccess(db.Model):
 
 class UserSettings(db.Model):
     __tablename__ = "user_settings"
+    __table_args__ = (
+        Index("uq_user_settings_user", "user_id", unique = True),
+    )
 
     id:      Mapped[int] = mapped_column(Integer, primary_key = True, autoincrement = True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable = False)
@@ -360,11 +457,64 @@ class UserSettings(db.Model):
 
     @staticmethod
     def settings(user: User | None) -> "UserSettings":
+        """ The user's settings, created on first use; loaded once per request """
         if not isinstance(user, User): return UserSettings()
-        res = db.session.execute(UserSettings.query.where(UserSettings.user_id == user.id)).scalar_one_or_none()
+        return memo(("settings", user.id), lambda: UserSettings.load(user.id))
+
+    @staticmethod
+    def load(user_id: int) -> "UserSettings":
+        res = db.session.execute(select(UserSettings).where(UserSettings.user_id == user_id)).scalar_one_or_none()
         if not isinstance(res, UserSettings):
-            res = UserSettings()
-            res.user_id = user.id
+            res = UserSettings(user_id)
             db.session.add(res)
             db.session.commit()
         return res
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # Workers claim the oldest queued job
+        Index("ix_jobs_status", "status", "id"),
+    )
+
+    QUEUED  = "queued"
+    RUNNING = "running"
+    DONE    = "done"
+    FAILED  = "failed"
+
+    id:         Mapped[int]      = mapped_column(Integer, primary_key = True, autoincrement = True)
+    kind:       Mapped[str]      = mapped_column(String(32),  nullable = False)
+    status:     Mapped[str]      = mapped_column(String(16),  nullable = False, default = "queued")
+    progress:   Mapped[float]    = mapped_column(Float,       nullable = False, default = 0)
+    message:    Mapped[str]      = mapped_column(String(256), nullable = False, default = "")
+    payload:    Mapped[str]      = mapped_column(Text,        nullable = False, default = "{}")
+    result:     Mapped[str|None] = mapped_column(Text,        nullable = True, default = None)
+    user_id:    Mapped[int|None] = mapped_column(ForeignKey("users.id"), nullable = True, default = None)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime, default = datetime.datetime.utcnow, nullable = False)
+    updated_at: Mapped[datetime.datetime] = mapped_column(DateTime, default = datetime.datetime.utcnow, onupdate = datetime.datetime.utcnow, nullable = False)
+
+    def __init__(self, kind: str, payload: str = "{}", user_id: int | None = None):
+        self.kind = kind
+        self.payload = payload
+        self.user_id = user_id
+        self.status = Job.QUEUED
+        self.progress = 0
+        self.message = ""
+
+    def hid(self) -> str:
+        return encode(self.id)
+
+    def is_finished(self) -> bool:
+        return self.status in (Job.DONE, Job.FAILED)
+
+    def data(self) -> dict:
+        return {
+            "id": self.hid(),
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat(),
+        }
@@ -1,13 +1,19 @@
 
 import shutil
 import os.path
-import requests
 from flask_login import current_user
-from flask import Blueprint, jsonify, request, send_file, url_for
-from app.lib.export import export_draft, import_draft
-from app.models import Draft, DraftAccess, DraftImage, DraftLabel, Image, Set, SkipImage, User
+from flask import Blueprint, current_app, jsonify, request, send_file, url_for
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import tuple_, update
+from app.lib.export import save_import
+from app.lib.jobs import enqueue
+from app.models import Draft, DraftAccess, DraftImage, DraftLabel, DraftRemoval, Image, Set, SkipImage, User
 from app.app import EXPORT_PATH, VALID_IMG_EXTENSIONS, db, UPLOAD_PATH, decode_image, draft_access_required, decode, encode, get_data, permission_required, log_info
-from app.lib.presentation import extract_images, get_free_filename, get_free_index, temp_remove
+from app.lib.presentation import get_free_filename, temp_save
+from app.lib.search_index import search_index
+from app.lib.publish import publish
+from app.lib import access, label_index
+from app.lib.image_download import ImageFetchError, image_extension, open_image, save_image_stream
 
 
 bp = Blueprint('api_draft', __name__, url_prefix='/api/draft')
@@ -23,10 +29,15 @@ def delete_all_drafts():
     db.session.query(DraftImage).delete()
     db.session.query(DraftLabel).delete()
     db.session.query(DraftAccess).delete()
+    db.session.query(DraftRemoval).delete()
     db.session.query(Draft).delete()
     db.session.query(Image).delete()
     db.session.query(Set).delete()
+    search_index.clear_sets()
+    label_index.remove_sets()
+    label_index.remove_drafts()
     db.session.commit()
+    access.cache.clear()  # Bulk deletes skip the flush hooks
 
     log_info(f"All drafts deleted by admin user {current_user.username} ({current_user.id})")
 
@@ -42,12 +53,18 @@ def delete_draft(draft: Draft):
     DraftImage.query.filter(DraftImage.draft_id == draft.id).delete()
     DraftLabel.query.filter(DraftLabel.draft_id == draft.id).delete()
     DraftAccess.query.filter(DraftAccess.draft_id == draft.id).delete()
+    DraftRemoval.query.filter(DraftRemoval.draft_id == draft.id).delete()
     image_ids = [i.id for i in Image.query.filter(Image.set_id == draft.set_id).all()]
     SkipImage.query.filter(SkipImage.image_id.in_(image_ids)).delete(synchronize_session=False)
     Image.query.filter(Image.set_id == draft.set_id).delete()
     Set.query.filter(Set.id == draft.set_id).delete()
+    search_index.remove_set(draft.set_id)
+    if draft.set_id is not None: label_index.remove_sets(draft.set_id)
+    label_index.remove_drafts(draft.id)
+    targets = {(access.DRAFT, draft.id), *([(access.SET, draft.set_id)] if draft.set_id is not None else [])}
     db.session.delete(draft)
     db.session.commit()
+    access.cache.invalidate(targets)  # The bulk deletes of the set and the grants skip the flush hooks
 
     log_info(f"Draft {draft.id} deleted successfully by user {current_user.id}")
 
@@ -101,24 +118,68 @@ def update_image_label(draft: Draft, image_hash: str):
 
 
 
+MAX_LABEL_BATCH = 500
+
+@bp.route('/<string:draft_hash>/images', methods=['POST'])
+@draft_access_required
+def update_image_labels(draft: Draft):
+    """
+    Apply many label edits in one transaction. Each edit is `{"id", "label", "notes", "seq"}`, where `seq` is the
+    image's `seq` the editor last saw; if another editor changed the image since, nothing is saved and the
+    current values of the conflicting images are returned with status 409.
+    """
+    data: dict = request.get_json(silent = True) or {}
+    edits = data.get('edits')
+    if not isinstance(edits, list) or not edits or len(edits) > MAX_LABEL_BATCH:
+        return jsonify({"error": f"Provide between 1 and {MAX_LABEL_BATCH} edits."}), 400
+    if not all(isinstance(edit, dict) for edit in edits): return jsonify({"error": "Invalid edit."}), 400
+
+    image_ids = [decode_image(str(edit.get('id', '')), draft.id) for edit in edits]
+    if any(image_id is False for image_id in image_ids): return jsonify({"error": "Invalid image hash."}), 400
+
+    if any(edit.get('seq') is not None and type(edit.get('seq')) is not int for edit in edits): return jsonify({"error": "Invalid seq."}), 400
+
+    # A no-op write that matches only images still at the seq the editor saw; it also holds them until the commit,
+    # so the images loaded below stay current
+    expected = {(image_id, edit['seq']) for image_id, edit in zip(image_ids, edits) if edit.get('seq') is not None}
+    claimed = db.session.execute(
+        update(DraftImage.__table__).where(DraftImage.draft_id == draft.id, tuple_(DraftImage.id, DraftImage.seq).in_(expected)).values(seq = DraftImage.seq)
+    ).rowcount if expected else 0
+
+    images = {image.id: image for image in DraftImage.query.filter(DraftImage.draft_id == draft.id, DraftImage.id.in_(image_ids))}
+    if len(images) != len(set(image_ids)):
+        db.session.rollback()
+        return jsonify({"error": "Image not found in draft."}), 404
+    if claimed != len(expected):
+        conflicts = list({image_id: images[image_id] for image_id, seq in expected if images[image_id].seq != seq}.values())
+        data = get_data(conflicts)
+        db.session.rollback()
+        return jsonify({"error": "Images were changed by another editor.", "conflicts": data}), 409
+
+    for image_id, edit in zip(image_ids, edits):
+        images[image_id].label = str(edit.get('label') or '').strip()
+        images[image_id].notes = str(edit.get('notes') or '').strip()
+    db.session.flush()  # Stamps the new `seq`; read before the commit expires every image
+    data = get_data(list(images.values()))
+    db.session.commit()
+
+    return jsonify({"message": "Image labels updated successfully.", "images": data}), 200
+
+
+
 @bp.route('/<string:draft_hash>/presentation', methods=['POST'])
 @draft_access_required
 def process_presentation(draft: Draft):
-    print("Processing presentation...", request.files["presentation"], request.form["draft"])
-    presentation = request.files['presentation']
+    presentation = request.files.get('presentation')
     if not presentation: return jsonify({"error": "No presentation file provided."}), 400
 
-    result = extract_images(presentation, draft.id)
-    if not result: return jsonify({"error": "Failed to process presentation."}), 500
-
-    print("Processing result:", result)
+    address = temp_save(presentation)
+    if not address: return jsonify({"error": "Failed to process presentation."}), 500
 
-    tmp_addr, images, labels = result
-    temp_remove(tmp_addr)
+    job = enqueue("presentation", {"path": address, "draft_id": draft.id}, current_user.id)
+    log_info(f"Queued presentation import job {job.id} for draft {draft.id} by user {current_user.id}")
 
-    log_info(f"Extracted {len(images)} images from presentation for draft {draft.id} by user {current_user.id}")
-
-    return jsonify({"images": get_data(images), "labels": get_data(labels)}), 200
+    return jsonify({"job_id": job.hid()}), 202
 
 
 
@@ -197,12 +258,10 @@ def add_image(draft: Draft):
     images = request.files.getlist('images')
     if not images: return jsonify({"error": "No image files provided."}), 400
 
-    index = get_free_index(draft.path, "img", "*")
     added_images = []
     for image in images:
         extension = os.path.splitext(image.filename or "")[1].lower().lstrip('.')
-        os.makedirs(draft.path, exist_ok=True)
-        filename = get_free_filename(draft.path, extension, "img", index)
+        filename = get_free_filename(draft.path, extension, "img")
 
         if not filename: return jsonify({"error": "Failed to generate filename."}), 500
         image_path = os.path.join(draft.path, filename)
@@ -227,30 +286,25 @@ def add_image_url(draft: Draft):
     if not image_url: return jsonify({"error": "No image URL provided."}), 400
 
     try:
-        headers = {'User-Agent': 'Recognify'}
-        # Bypass proxy to avoid connection issues
-        proxies = {}
-        response = requests.get(image_url, timeout=10, headers=headers, proxies=proxies)
-        response.raise_for_status()
-    except requests.RequestException as e:
-        return jsonify({"error": f"Failed to fetch image from URL: {str(e)}"}), 400
-
-    content_type = response.headers.get('Content-Type', '')
-    if 'image' not in content_type:
-        return jsonify({"error": "URL does not point to a valid image."}), 400
-
-    extension = content_type.split('/')[-1]
-    if not extension in VALID_IMG_EXTENSIONS:
-        return jsonify({"error": f"Not a valid image extension: {extension}"}), 400
-    
-    index = get_free_index(draft.path, "img", "*")
-    filename = get_free_filename(draft.path, extension, "img", index)
+        response = open_image(image_url)
+    except ImageFetchError as e:
+        return jsonify({"error": str(e)}), 400
 
-    if not filename: return jsonify({"error": "Failed to generate filename."}), 500
-    image_path = os.path.join(draft.path, filename)
+    with response:
+        extension = image_extension(response)
+        if not extension in VALID_IMG_EXTENSIONS:
+            return jsonify({"error": f"Not a valid image extension: {extension}"}), 400
 
-    with open(image_path, 'wb') as f:
-        f.write(response.content)
+        filename = get_free_filename(draft.path, extension, "img")
+
+        if not filename: return jsonify({"error": "Failed to generate filename."}), 500
+        image_path = os.path.join(draft.path, filename)
+
+        try:
+            save_image_stream(response, image_path)
+        except ImageFetchError as e:
+            os.remove(image_path)
+            return jsonify({"error": str(e)}), 400
 
     i = DraftImage(draft.id, filename, presentation_n = -1, slide_n = 0, label = label)
     db.session.add(i)
@@ -260,6 +314,29 @@ def add_image_url(draft: Draft):
 
 
 
+@bp.route('/<string:draft_hash>/gallery/urls', methods=['POST'])
+@draft_access_required
+def add_image_urls(draft: Draft):
+    """ Queue a download of many `{"url", "label"}` images into the draft gallery; the job reports progress and per-image failures """
+    data: dict = request.get_json(silent = True) or {}
+    images = data.get('images')
+    limit = current_app.config["IMAGE_BATCH_MAX"]
+    if not isinstance(images, list) or not images or len(images) > limit:
+        return jsonify({"error": f"Provide between 1 and {limit} images."}), 400
+
+    items: list[dict[str, str]] = []
+    for image in images:
+        url = str(image.get('url', '')).strip() if isinstance(image, dict) else ''
+        if not url.startswith(('http://', 'https://')): return jsonify({"error": f"Invalid image URL: {url}"}), 400
+        items.append({"url": url, "label": str(image.get('label') or '').strip()})
+
+    job = enqueue("image_urls", {"draft_id": draft.id, "images": items}, current_user.id)
+    log_info(f"Queued download of {len(items)} images for draft {draft.id} by user {current_user.id} as job {job.id}")
+
+    return jsonify({"job_id": job.hid()}), 202
+
+
+
 @bp.route('/<string:draft_hash>/image/<string:image_hash>/file', methods=['PUT'])
 @draft_access_required
 def replace_image_from_file(draft: Draft, image_hash: str):
@@ -275,8 +352,7 @@ def replace_image_from_file(draft: Draft, image_hash: str):
     extension = os.path.splitext(image_file.filename or "")[1].lower().lstrip('.')
     if not extension in VALID_IMG_EXTENSIONS:
         return jsonify({"error": f"Not a valid image extension: {extension}"}), 400
-    index = get_free_index(draft.path, "img", "*")
-    filename = get_free_filename(draft.path, extension, "img", index)
+    filename = get_free_filename(draft.path, extension, "img")
 
     if not filename: return jsonify({"error": "Failed to generate filename."}), 500
     image_path = os.path.join(draft.path, filename)
@@ -284,8 +360,10 @@ def replace_image_from_file(draft: Draft, image_hash: str):
     os.remove(os.path.join(draft.path, draft_image.filename))
 
     draft_image.filename = filename
+    db.session.flush()  # Stamps the new `seq`
+    seq = draft_image.seq
     db.session.commit()
-    return jsonify({"message": "Image replaced successfully."}), 200
+    return jsonify({"message": "Image replaced successfully.", "seq": seq}), 200
 
 
 
@@ -304,38 +382,35 @@ def replace_image_from_url(draft: Draft, image_hash: str):
     print(f"Changing image (id {draft_image.id}) to url '{url}'")
     
     try:
-        headers = {'User-Agent': 'Recognify'}
-        # Bypass proxy to avoid connection issues
-        proxies = {}
-        response = requests.get(url, timeout=10, headers=headers, proxies=proxies)
-        response.raise_for_status()
-    except requests.RequestException as e:
-        return jsonify({"error": f"Failed to fetch image from URL: {str(e)}"}), 400
-
-    content_type = response.headers.get('Content-Type', '')
-    if 'image' not in content_type:
-        return jsonify({"error": "URL does not point to a valid image."}), 400
-
-    extension = content_type.split('/')[-1]
-    if not extension in VALID_IMG_EXTENSIONS:
-        return jsonify({"error": f"Not a valid image extension: {extension}"}), 400
-    
-    index = get_free_index(draft.path, "img", "*")
-    filename = get_free_filename(draft.path, extension, "img", index)
+        response = open_image(url)
+    except ImageFetchError as e:
+        return jsonify({"error": str(e)}), 400
 
-    if not filename: return jsonify({"error": "Failed to generate filename."}), 500
-    image_path = os.path.join(draft.path, filename)
+    with response:
+        extension = image_extension(response)
+        if not extension in VALID_IMG_EXTENSIONS:
+            return jsonify({"error": f"Not a valid image extension: {extension}"}), 400
 
-    with open(image_path, 'wb') as f:
-        f.write(response.content)
+        filename = get_free_filename(draft.path, extension, "img")
+
+        if not filename: return jsonify({"error": "Failed to generate filename."}), 500
+        image_path = os.path.join(draft.path, filename)
+
+        try:
+            save_image_stream(response, image_path)
+        except ImageFetchError as e:
+            os.remove(image_path)
+            return jsonify({"error": str(e)}), 400
 
     print("image saved.")
 
     draft_image.filename = filename
     draft_image.slide = -10000
 
+    db.session.flush()  # Stamps the new `seq`
+    seq = draft_image.seq
     db.session.commit()
-    return jsonify({"message": "Image replaced successfully."}), 200
+    return jsonify({"message": "Image replaced successfully.", "seq": seq}), 200
 
 
 
@@ -366,68 +441,28 @@ def update_thumbnail(draft: Draft):
 @bp.route('/<string:draft_hash>/submit', methods=['POST'])
 @draft_access_required
 def publish_draft(draft: Draft):
-    if not draft.images: return jsonify({"error": "Draft has no images."}), 400
-
-    set_id = draft.set_id
-    if set_id is None:
-        # Create new set
-        set_ = Set(name = draft.name or "Untitled Set", description = draft.description or "", is_public = draft.is_public)
-        set_.thumbnail = draft.thumbnail
-        db.session.add(set_)
-        db.session.commit()
-
-        for img in draft.images:
-            if not img.label: continue
-            new_img = Image(filename = img.filename, set_id = set_.id, label = img.label, notes = img.notes, draft_image_id = img.id)
-            db.session.add(new_img)
-            set_.images.append(new_img)
-
-        draft.set_id = set_.id
-        set_id = set_.id
-        db.session.commit()
-    else:
-        # Update existing set
-        set_ = Set.query.get(set_id)
-        if not isinstance(set_, Set):
-            return jsonify({"error": "Associated set not found."}), 404
-        set_.name = draft.name or set_.name
-        set_.description = draft.description or set_.description
-        set_.thumbnail = draft.thumbnail or set_.thumbnail
-        set_.is_public = draft.is_public
-
-        set_images = {img.filename: False for img in set_.images}
-        for draft_img in draft.images:
-            if not draft_img.label: continue
-            if draft_img.filename in set_images:
-                # Existing image, update label and notes
-                img = Image.query.filter_by(filename=draft_img.filename).first()
-                if not isinstance(img, Image): continue
-                img.label = draft_img.label
-                img.notes = draft_img.notes
-                set_images[draft_img.filename] = True
-            else:
-                # New image, add to set
-                new_img = Image(filename = draft_img.filename, set_id = set_.id, label = draft_img.label, notes = draft_img.notes, draft_image_id = draft_img.id)
-                db.session.add(new_img)
-                set_.images.append(new_img)
-        
-        # Delete images that are in the set but not in the draft
-        for filename, found in set_images.items():
-            if found: continue
-
-            img = Image.query.filter_by(set_id=set_.id, filename=filename).first()
-            if not isinstance(img, Image): continue
-            SkipImage.query.filter(SkipImage.image_id == img.id).delete()
-            db.session.delete(img)
-
-        db.session.commit()
-
-    log_info(f"Draft {draft.id} published by user {current_user.id} as set {set_.name} ({set_.id})")
+    if not DraftImage.query.filter(DraftImage.draft_id == draft.id).first(): return jsonify({"error": "Draft has no images."}), 400
+    if draft.set_id is not None and db.session.get(Set, draft.set_id) is None:
+        return jsonify({"error": "Associated set not found."}), 404
+
+    set_, changes = publish(draft)
+    set_id = set_.id
+    db.session.commit()
+
+    log_info(f"Draft {draft.id} published by user {current_user.id} as set {set_.name} ({set_.id}): {changes['added']} added, {changes['changed']} changed, {changes['removed']} removed")
 
     return jsonify({"message": "Draft published successfully.", "set_id": encode(set_id)}), 200
 
 
 
+@bp.route('/<string:draft_hash>/status', methods=['GET'])
+@draft_access_required
+def draft_status(draft: Draft):
+    """ Whether the set is behind the draft; reads only the draft row """
+    return jsonify({"is_published": draft.is_published(), "has_unpublished_changes": draft.has_unpublished_changes()}), 200
+
+
+
 @bp.route('/<string:draft_hash>/access', methods=['POST'])
 @draft_access_required
 def add_draft_access(draft: Draft):
@@ -438,9 +473,13 @@ def add_draft_access(draft: Draft):
     user_obj = User.query.filter((User.email == user) | (User.username == user)).first()
     if not isinstance(user_obj, User): return jsonify({"error": "User not found."}), 404
 
-    draft_access = DraftAccess(draft_id = draft.id, user_id = user_obj.id)
-    db.session.add(draft_access)
-    db.session.commit()
+    # Granting twice is a no-op; the ORM insert (rather than an upsert) keeps the access cache invalidation hook
+    if not DraftAccess.query.filter_by(draft_id = draft.id, user_id = user_obj.id).first():
+        db.session.add(DraftAccess(draft_id = draft.id, user_id = user_obj.id))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # Granted by a concurrent request
 
     return jsonify({"message": "Access granted successfully.", "user": user_obj.data()}), 200
 
@@ -460,15 +499,14 @@ def remove_draft_access(draft: Draft):
 @bp.route('/<string:draft_hash>/export', methods=['POST'])
 @draft_access_required
 def export_draft_api(draft: Draft):
-    filename = export_draft(draft)
-    if filename == False: return jsonify({"error": "Failed to export draft."}), 500
-    return send_file(os.path.join(EXPORT_PATH, filename)), 200
+    job = enqueue("export_draft", {"draft_id": draft.id}, current_user.id)
+    return jsonify({"job_id": job.hid()}), 202
 
 
 @bp.route('/import', methods=['POST'])
 def import_draft_api():
+    if not current_user.is_authenticated: return jsonify({"error": "Unauthorized."}), 403
     file = request.files.get('file')
     if not file: return jsonify({"error": "No file provided."}), 400
-    draft_id = import_draft(file)
-    if not draft_id: return jsonify({"error": "Failed to import draft."}), 500
-    return jsonify({"message": "Draft imported successfully.", "draft_id": encode(draft_id)}), 200
+    job = enqueue("import_draft", {"path": save_import(file), "owner_id": current_user.id}, current_user.id)
+    return jsonify({"job_id": job.hid()}), 202
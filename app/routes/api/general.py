@@ -1,13 +1,16 @@
 
-from flask import Blueprint, jsonify, request, send_file
+from flask import Blueprint, current_app, jsonify, request, send_file
 from flask_login import current_user
 from urllib.parse import unquote
 import os.path
 
 from app.lib.export import export_draft
 from app.models import Draft, DraftAccess, Image, Set, SkipImage, User, UserSettings
-from app.app import EXPORT_PATH, db, UPLOAD_PATH, decode, decode_image, encode, get_data, log_info, login_required, set_access_required
-from app.lib.inaturalist_api import get_inaturalist_image_links
+from app.app import EXPORT_PATH, db, UPLOAD_PATH, decode, decode_cursor, decode_image, encode, get_data, log_info, login_required, permission_required, set_access_required
+from app.lib.inaturalist_api import page_cache
+from app.lib.jobs import enqueue
+from app.lib.search_index import search_index
+from app.lib import access, label_index
 
 
 bp = Blueprint('api_general', __name__, url_prefix='/api')
@@ -19,6 +22,26 @@ def api_index():
 
 
 
+@bp.route('/sets', methods=['GET'])
+def list_sets():
+    MAX_LIMIT = 100
+
+    after = decode_cursor(request.args.get('after'))
+    if after is False: return jsonify({"error": "Invalid page cursor."}), 400
+    limit = request.args.get('limit', current_app.config["SETS_PER_PAGE"], type = int)
+    limit = max(1, min(limit, MAX_LIMIT))
+
+    query = Set.visible_to(current_user)
+    if owner_hash := request.args.get('owner'):
+        owner_id = decode(owner_hash)
+        if not isinstance(owner_id, int): return jsonify({"error": "Invalid user hash."}), 400
+        query = query.where(Set.owner_id == owner_id)
+
+    sets, next_cursor = Set.page(query, after, limit)
+    return jsonify({"sets": get_data(sets), "next": next_cursor}), 200
+
+
+
 @bp.route('/sets', methods=['DELETE'])
 def delete_all_sets():
     user = current_user
@@ -26,7 +49,10 @@ def delete_all_sets():
         return jsonify({"error": "Unauthorized."}), 403
     db.session.query(Image).delete()
     db.session.query(Set).delete()
+    search_index.clear_sets()
+    label_index.remove_sets()
     db.session.commit()
+    access.cache.clear()  # Bulk deletes skip the flush hooks
 
     log_info(f"All sets deleted by admin user {user.username} ({user.id}).")
 
@@ -44,7 +70,10 @@ def delete_set(set_hash: str):
 
     db.session.query(Image).filter(Image.set_id == set_.id).delete()
     db.session.delete(set_)
+    search_index.remove_set(set_.id)
+    label_index.remove_sets(set_.id)
     db.session.commit()
+    access.cache.invalidate({(access.SET, set_id)})  # A later set may reuse the id
 
     log_info(f"Set {set_.name} ({set_.id}) deleted by user {current_user.username} ({current_user.id}).")
 
@@ -75,23 +104,32 @@ def get_set_image(set_hash: str, image_hash: str):
 
 
 
+MAX_SKIP_BATCH = 500
+
+def skip_request_images(set_id: int) -> list[int] | None:
+    """ Image ids of a skip request, given as `image_ids` (a list of hashes) or a single `image_id`; None if any is invalid """
+    data: dict = request.get_json(silent = True) or {}
+    hashes = data.get('image_ids', [data['image_id']] if 'image_id' in data else [])
+    if not isinstance(hashes, list) or not hashes or len(hashes) > MAX_SKIP_BATCH: return None
+
+    image_ids = [decode_image(str(image_hash), set_id) for image_hash in hashes]
+    if any(image_id is False for image_id in image_ids): return None
+    return [image_id for image_id in image_ids if image_id is not False]
+
+
+
 @bp.route('/sets/<string:set_hash>/skip', methods=['POST'])
 def skip_set_image(set_hash: str):
     if not current_user.is_authenticated: return jsonify({"error": "Unauthorized."}), 403
     set_id = decode(set_hash)
     if not isinstance(set_id, int): return jsonify({"error": "Invalid set hash."}), 400
-    set_ = Set.query.get(set_id)
-    if not isinstance(set_, Set): return jsonify({"error": "Set not found."}), 404
-    data: dict[str, int] = request.get_json()
-    image_id = decode_image(str(data.get('image_id', '')), set_id)
-    image = Image.query.get(image_id)
-    if not isinstance(image, Image) or image.set_id != set_.id:
-        return jsonify({"error": "Image not found in set."}), 404
-    
-    si = SkipImage(current_user.id, image_id)
-    db.session.add(si)
+    if db.session.get(Set, set_id) is None: return jsonify({"error": "Set not found."}), 404
+    image_ids = skip_request_images(set_id)
+    if image_ids is None: return jsonify({"error": f"Invalid image hashes (at most {MAX_SKIP_BATCH} per request)."}), 400
+
+    added = SkipImage.add_many(current_user.id, set_id, image_ids)
     db.session.commit()
-    return jsonify({"message": "Image marked as skipped."}), 200
+    return jsonify({"message": "Images marked as skipped.", "added": added}), 200
 
 
 
@@ -100,22 +138,18 @@ def remove_skip_set_image(set_hash: str):
     if not current_user.is_authenticated: return jsonify({"error": "Unauthorized."}), 403
     set_id = decode(set_hash)
     if not isinstance(set_id, int): return jsonify({"error": "Invalid set hash."}), 400
-    set_ = Set.query.get(set_id)
-    if not isinstance(set_, Set): return jsonify({"error": "Set not found."}), 404
-    data: dict[str, int] = request.get_json()
-    image_id = decode_image(str(data.get('image_id', '')), set_id)
-    image = Image.query.get(image_id)
-    if not isinstance(image, Image) or image.set_id != set_.id:
-        return jsonify({"error": "Image not found in set."}), 404
-    
-    si = SkipImage(current_user.id, image_id)
-    db.session.add(si)
+    if db.session.get(Set, set_id) is None: return jsonify({"error": "Set not found."}), 404
+    image_ids = skip_request_images(set_id)
+    if image_ids is None: return jsonify({"error": f"Invalid image hashes (at most {MAX_SKIP_BATCH} per request)."}), 400
+
+    removed = SkipImage.remove_many(current_user.id, set_id, image_ids)
     db.session.commit()
-    return jsonify({"message": "Image marked as skipped."}), 200
+    return jsonify({"message": "Images no longer skipped.", "removed": removed}), 200
 
 
 
 @bp.route('/inaturalist/links', methods=['GET'])
+@login_required
 def inaturalist_links():
     try:
         species_param = request.args.get('species', '')
@@ -131,10 +165,9 @@ def inaturalist_links():
         if len(species_list) > MAX_SPECIES:
             return jsonify({"error": f"Too many species requested. Maximum is {MAX_SPECIES}, you requested {len(species_list)}. Please split into smaller batches."}), 400
 
-        log_info(f"Fetching iNaturalist links for {len(species_list)} species...")
-        links = get_inaturalist_image_links(species_list)
-        log_info(f"Successfully fetched links for {len(links)} species")
-        return jsonify({"links": links})
+        job = enqueue("inaturalist_links", {"species": species_list}, current_user.id)
+        log_info(f"Queued iNaturalist links job {job.id} for {len(species_list)} species")
+        return jsonify({"job_id": job.hid()}), 202
     except Exception as e:
         log_info(f"Error in inaturalist_links: {type(e).__name__}: {str(e)}")
         import traceback
@@ -143,6 +176,14 @@ def inaturalist_links():
 
 
 
+@bp.route('/inaturalist/cache', methods=['GET'])
+@login_required
+@permission_required(10)
+def inaturalist_cache_stats():
+    return jsonify(page_cache.stats()), 200
+
+
+
 @bp.route('/search', methods=['GET'])
 def api_search():
     query = request.args.get('q', '')
@@ -150,23 +191,8 @@ def api_search():
     SET_LIMIT = 10
     USER_LIMIT = 5
 
-    if current_user.is_authenticated:
-        sets: list[Set] = Set.query.join(Draft, Set.id == Draft.set_id)\
-            .outerjoin(DraftAccess, Draft.id == DraftAccess.draft_id)\
-            .where(
-                Set.name.ilike(f'%{query}%'),
-                (Set.is_public == True) | 
-                (Set.owner_id == current_user.id) | 
-                (Draft.owner_id == current_user.id) |
-                (DraftAccess.user_id == current_user.id)
-            ).limit(SET_LIMIT).distinct().all()
-    else:
-        sets: list[Set] = Set.query.where(
-            Set.name.ilike(f'%{query}%'),
-            Set.is_public == True
-        ).limit(SET_LIMIT).all()
-
-    users: list[User] = User.query.where(User.username.ilike(f'%{query}%')).limit(USER_LIMIT).all()
+    sets = search_index.find_sets(query, current_user, SET_LIMIT)
+    users = search_index.find_users(query, USER_LIMIT)
 
     set_data = [
         {
@@ -189,6 +215,15 @@ def api_search():
     return jsonify({"sets": set_data, "users": user_data}), 200
 
 
+@bp.route('/search/labels', methods=['GET'])
+def api_search_labels():
+    RESULT_LIMIT = 10
+    IMAGE_LIMIT = 20
+
+    query = request.args.get('q', '')
+    return jsonify(label_index.search(query, current_user, RESULT_LIMIT, IMAGE_LIMIT)), 200
+
+
 @login_required
 @bp.route('/user/settings', methods=['GET'])
 def get_user_settings():
@@ -0,0 +1,45 @@
+import json
+import os.path
+from flask import Blueprint, jsonify, send_file
+from flask_login import current_user
+
+from app.models import Job
+from app.app import EXPORT_PATH, db, decode
+
+
+bp = Blueprint('api_jobs', __name__, url_prefix='/api/jobs')
+
+
+def get_job(job_hash: str) -> Job | None:
+    """ Return the job if it exists and the current user may see it. """
+    job_id = decode(job_hash)
+    if job_id is False: return None
+
+    job = db.session.get(Job, job_id)
+    if not isinstance(job, Job): return None
+    # Every job belongs to the signed-in user who queued it
+    if not current_user.is_authenticated or job.user_id is None or current_user.id != job.user_id: return None
+    return job
+
+
+
+@bp.route('/<string:job_hash>', methods=['GET'])
+def job_status(job_hash: str):
+    job = get_job(job_hash)
+    if job is None: return jsonify({"error": "Job not found."}), 404
+    return jsonify(job.data()), 200
+
+
+
+@bp.route('/<string:job_hash>/result', methods=['GET'])
+def job_result(job_hash: str):
+    job = get_job(job_hash)
+    if job is None: return jsonify({"error": "Job not found."}), 404
+    if job.status == Job.FAILED: return jsonify({"error": job.message or "Job failed."}), 500
+    if job.status != Job.DONE: return jsonify({"error": "Job has not finished yet.", "status": job.status}), 409
+
+    result: dict = json.loads(job.result or "{}")
+    if "file" in result:
+        return send_file(os.path.join(EXPORT_PATH, result["file"]), as_attachment = True, download_name = result.get("download_name")), 200
+
+    return jsonify(result), 200
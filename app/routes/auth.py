@@ -5,6 +5,7 @@ from flask_login import login_user, logout_user
 
 from app.models import User
 from app.app import db, log_info
+from app.lib.search_index import search_index
 
 
 bp = Blueprint("auth", __name__, url_prefix = "/auth")
@@ -53,6 +54,8 @@ def signup_post():
     
     user = User(username = username, email = email, password = pwd_hash)
     db.session.add(user)
+    db.session.flush()
+    search_index.index_user(user)
     db.session.commit()
 
     log_info(f"New user registered: {username}")
@@ -1,30 +1,40 @@
 
-from flask import Blueprint, jsonify, redirect, render_template, request
+from flask import Blueprint, current_app, jsonify, redirect, render_template, request
 from flask_login import current_user
 from app.models import Draft, DraftAccess, Image, Set, SkipImage, User
-from app.app import db, draft_access_required, encode, get_data, login_required, decode, encode, log_info, set_access_required
+from app.app import db, decode_cursor, draft_access_required, encode, get_data, login_required, decode, encode, log_info, set_access_required
 from app.lib.presentation import create_draft
+from app.lib.search_index import search_index
 
 bp = Blueprint("main", __name__)
 
+POPULAR_SETS = 5
+
 @bp.route('/')
-@bp.route('/sets')
 def index():
-    sets = Set.all_for(current_user)
+    popular_sets, _ = Set.page(Set.visible_to(current_user), limit = POPULAR_SETS)
     drafts = []
 
     if current_user.is_authenticated:
         drafts = current_user.get_drafts()
     
-    return render_template('index.html', sets = sets, drafts = drafts, popular_sets = sets[:5])
+    return render_template('index.html', drafts = drafts, popular_sets = popular_sets)
+
+@bp.route('/sets')
+def browse_sets():
+    after = decode_cursor(request.args.get('after'))
+    if after is False: return "Invalid page cursor", 400
+
+    sets, next_cursor = Set.page(Set.visible_to(current_user), after, current_app.config["SETS_PER_PAGE"])
+
+    return render_template('index.html', sets = sets, next_cursor = next_cursor)
 
 @bp.route('/search')
 def search():
-    query = request.args.get('q', '')
+    SEARCH_LIMIT = 100
 
-    results = []
-    results.extend(Set.query.where(Set.name.ilike(f'%{query}%')).all())
-    results.extend(filter(lambda x: x not in results, Set.query.where(Set.description.ilike(f'%{query}%')).all()))
+    query = request.args.get('q', '')
+    results = search_index.find_sets(query, current_user, SEARCH_LIMIT)
 
     return render_template('search.html', search_query = query, search_results = results)
 
@@ -41,12 +51,8 @@ def view_set(set_: Set):
     return render_template('set_view.html', set = set_)
 
 @bp.route('/sets/<string:set_hash>/cards')
-def set_cards(set_hash: str):
-    set_id = decode(set_hash)
-    if not isinstance(set_id, int): return "Invalid set hash", 400
-    set_ = Set.query.get(set_id)
-    if not isinstance(set_, Set): return "Set not found", 404
-
+@set_access_required
+def set_cards(set_: Set):
     return render_template('set_cards.html', set = set_, anonymous = current_user.is_anonymous)
 
 @bp.route('/draft/<string:draft_hash>')
@@ -68,19 +74,13 @@ def profile(user_hash: str):
     user = db.session.execute(User.query.where(User.id == user_id)).scalar_one_or_none()
     if not isinstance(user, User): return "User not found", 404
 
-    current_user_id = current_user.id if current_user.is_authenticated else None
-
-    sets_query = Set.query.where(Set.owner_id == user.id)
+    after = decode_cursor(request.args.get('after'))
+    if after is False: return "Invalid page cursor", 400
 
-    if current_user.is_authenticated and current_user.id == user.id:
-        sets = sets_query.all()
-    else:
-        sets = sets_query.outerjoin(Draft, Draft.set_id == Set.id) \
-            .outerjoin(DraftAccess, DraftAccess.draft_id == Draft.id) \
-            .where((Set.is_public == True) | (DraftAccess.user_id == current_user_id)) \
-            .distinct().all()
+    sets_query = Set.visible_to(current_user).where(Set.owner_id == user.id)
+    sets, next_cursor = Set.page(sets_query, after, current_app.config["SETS_PER_PAGE"])
 
-    return render_template('profile.html', user = user, sets = sets)
+    return render_template('profile.html', user = user, sets = sets, next_cursor = next_cursor)
 
 @bp.route('/profile')
 @login_required
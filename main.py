@@ -1,4 +1,7 @@
+from flask_migrate import upgrade
+
 from app.main import app
 
 if __name__ == "__main__":
+    with app.app_context(): upgrade()  # The development server migrates itself, deployments run `flask db upgrade`
     app.run(debug = True)
@@ -0,0 +1,55 @@
+"""Indexes on hot lookups, one skip/access/settings row per user
+
+Revision ID: 3f1c2b7a9d40
+Revises:
+Create Date: 2026-10-18 15:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2b7a9d40'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# name, table, columns, unique
+INDEXES = [
+    ("ix_sets_public_created",      "sets",          ["is_public", "created_at", "id"], False),
+    ("ix_sets_owner_created",       "sets",          ["owner_id", "created_at", "id"],  False),
+    ("ix_images_set_filename",      "images",        ["set_id", "filename"],            False),
+    ("ix_drafts_set",               "drafts",        ["set_id"],                        False),
+    ("ix_drafts_owner",             "drafts",        ["owner_id"],                      False),
+    ("ix_draft_images_draft",       "draft_images",  ["draft_id", "slide"],             False),
+    ("ix_draft_labels_draft",       "draft_labels",  ["draft_id", "slide"],             False),
+    ("uq_skip_images_user_image",   "skip_images",   ["user_id", "image_id"],           True),
+    ("ix_skip_images_image",        "skip_images",   ["image_id"],                      False),
+    ("uq_draft_access_draft_user",  "draft_access",  ["draft_id", "user_id"],           True),
+    ("ix_draft_access_user",        "draft_access",  ["user_id", "draft_id"],           False),
+    ("uq_user_settings_user",       "user_settings", ["user_id"],                       True),
+    ("ix_jobs_status",              "jobs",          ["status", "id"],                  False),
+]
+
+# Rows that would violate the new unique indexes; the oldest row of each group is kept
+DUPLICATES = [
+    ("skip_images",   "user_id, image_id"),
+    ("draft_access",  "draft_id, user_id"),
+    ("user_settings", "user_id"),
+]
+
+
+def upgrade():
+    for table, columns in DUPLICATES:
+        op.execute(sa.text(f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {columns})"))
+
+    # Databases created by db.create_all() after these were declared already have them
+    for name, table, columns, unique in INDEXES:
+        op.create_index(name, table, columns, unique = unique, if_not_exists = True)
+
+
+def downgrade():
+    for name, table, _, _ in reversed(INDEXES):
+        op.drop_index(name, table_name = table, if_exists = True)
@@ -0,0 +1,58 @@
+"""Change sequence on drafts and draft images, removals since the last publish
+
+Revision ID: 8a4e6d2c5b17
+Revises: 3f1c2b7a9d40
+Create Date: 2026-10-18 17:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6d2c5b17'
+down_revision = '3f1c2b7a9d40'
+branch_labels = None
+depends_on = None
+
+
+# table, column
+COLUMNS = [
+    ("drafts",       "change_seq"),
+    ("drafts",       "last_published_seq"),
+    ("draft_images", "seq"),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    # Databases created by db.create_all() after these were declared already have them
+    for table, column in COLUMNS:
+        if column in {c["name"] for c in inspector.get_columns(table)}: continue
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column(column, sa.Integer(), nullable = False, server_default = "0"))
+
+    if not inspector.has_table("draft_removals"):
+        op.create_table(
+            "draft_removals",
+            sa.Column("id", sa.Integer(), primary_key = True, autoincrement = True),
+            sa.Column("draft_id", sa.Integer(), sa.ForeignKey("drafts.id"), nullable = False),
+            sa.Column("filename", sa.String(128), nullable = False),
+            sa.Column("seq", sa.Integer(), nullable = False),
+        )
+    op.create_index("ix_draft_removals_seq", "draft_removals", ["draft_id", "seq"], if_not_exists = True)
+    op.create_index("ix_draft_images_seq", "draft_images", ["draft_id", "seq"], if_not_exists = True)
+
+    # Edits made before tracking are unknown: mark every existing row as changed, so the next publish of each draft is a full one
+    op.execute(sa.text("UPDATE drafts SET change_seq = 1, last_published_seq = 0"))
+    op.execute(sa.text("UPDATE draft_images SET seq = 1"))
+
+
+def downgrade():
+    op.drop_index("ix_draft_images_seq", table_name = "draft_images", if_exists = True)
+    op.drop_table("draft_removals")
+    with op.batch_alter_table("draft_images") as batch_op:
+        batch_op.drop_column("seq")
+    with op.batch_alter_table("drafts") as batch_op:
+        batch_op.drop_column("last_published_seq")
+        batch_op.drop_column("change_seq")
@@ -0,0 +1,23 @@
+
+export async function waitForJobDone(jobId, onProgress = null, interval = 1000) {
+  /* Poll a background job until it finishes and return its final status */
+  while (true) {
+    const status = (await axios.get(`/api/jobs/${jobId}`)).data;
+    if (onProgress) {onProgress(status);}
+
+    if (status.status === 'done') {return status;}
+    if (status.status === 'failed') {throw new Error(status.message || 'Job failed.');}
+
+    await new Promise(resolve => setTimeout(resolve, interval));
+  }
+}
+
+export async function waitForJob(jobId, onProgress = null, interval = 1000) {
+  /* Poll a background job until it finishes and return its result */
+  await waitForJobDone(jobId, onProgress, interval);
+  return (await axios.get(jobResultUrl(jobId))).data;
+}
+
+export function jobResultUrl(jobId) {
+  return `/api/jobs/${jobId}/result`;
+}